@@ -1,79 +1,605 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, WebSocket, WebSocketDisconnect, status
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Query, Request, Response, UploadFile, File, WebSocket, WebSocketDisconnect, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne, monitoring
+from pymongo.errors import DuplicateKeyError, BulkWriteError
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict, EmailStr
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Set, Callable, Awaitable, Tuple, Literal
 import uuid
 from datetime import datetime, timezone, timedelta
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 import json
 import httpx
+try:
+    import orjson
+except ImportError:  # optional: only used when FAST_JSON is enabled
+    orjson = None
 import asyncio
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import importlib
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from collections import OrderedDict
+import hashlib
+import hmac
+import base64
+import csv
+import io
+import time
+import threading
+import multiprocessing
+from contextlib import asynccontextmanager
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+# MongoDB connection pool, sized from the environment. Motor connects lazily,
+# so the client is built at import and closed by the app lifespan.
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "100"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "0"))  # 0 waits indefinitely
+MONGO_COMPRESSORS = os.getenv("MONGO_COMPRESSORS", "")  # e.g. "zstd,snappy,zlib"
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """Connection checkout counters and pool wait times. pymongo emits these
+    events from the executor threads Motor runs operations on, and a checkout
+    starts and finishes on the same thread."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.open_connections = 0
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.checkouts = 0
+        self.checkout_failures: Dict[str, int] = {}
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.pool_clears = 0
+
+    def connection_check_out_started(self, event):
+        self.local.started = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        waited = time.perf_counter() - getattr(self.local, "started", time.perf_counter())
+        with self.lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+
+    def connection_check_out_failed(self, event):
+        with self.lock:
+            self.checkout_failures[event.reason] = self.checkout_failures.get(event.reason, 0) + 1
+
+    def connection_checked_in(self, event):
+        with self.lock:
+            self.in_use -= 1
+
+    def connection_created(self, event):
+        with self.lock:
+            self.open_connections += 1
+
+    def connection_closed(self, event):
+        with self.lock:
+            self.open_connections -= 1
+
+    def pool_cleared(self, event):
+        with self.lock:
+            self.pool_clears += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def metrics(self) -> dict:
+        with self.lock:
+            return {
+                "max_pool_size": MONGO_MAX_POOL_SIZE,
+                "min_pool_size": MONGO_MIN_POOL_SIZE,
+                "wait_queue_timeout_ms": MONGO_WAIT_QUEUE_TIMEOUT_MS or None,
+                "compressors": MONGO_COMPRESSORS or None,
+                "open_connections": self.open_connections,
+                "in_use": self.in_use,
+                "peak_in_use": self.peak_in_use,
+                "checkouts": self.checkouts,
+                "checkout_failures": dict(self.checkout_failures),
+                "wait_avg_ms": round(self.wait_total / self.checkouts * 1000, 3) if self.checkouts else 0.0,
+                "wait_max_ms": round(self.wait_max * 1000, 3),
+                "pool_clears": self.pool_clears
+            }
+
+mongo_pool_metrics = PoolMetrics()
+
+# Every read should name the fields it needs. This listener flags find and
+# findAndModify commands sent without a projection (or with an exclusion-only
+# one, which still ships the whole document). Off by default; the server that
+# backend_test.py runs against sets QUERY_AUDIT=true, and the suite asserts
+# that none were seen after exercising the API.
+QUERY_AUDIT = os.getenv("QUERY_AUDIT", "false").lower() == "true"
+
+class QueryAudit(monitoring.CommandListener):
+    PROJECTION_FIELDS = {"find": "projection", "findAndModify": "fields"}
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.unprojected: Dict[str, dict] = {}
+
+    def command_started(self, event):
+        field = self.PROJECTION_FIELDS.get(event.command_name)
+        if field is None:
+            return
+        projection = event.command.get(field)
+        if projection and any(value not in (0, False) for value in projection.values()):
+            return
+        collection = event.command.get(event.command_name)
+        key = f"{collection}.{event.command_name}"
+        with self.lock:
+            entry = self.unprojected.setdefault(key, {"count": 0, "filter_fields": []})
+            entry["count"] += 1
+            # Field names only; filter values may hold personal data
+            entry["filter_fields"] = sorted((event.command.get("filter") or event.command.get("query") or {}).keys())
+
+    def command_succeeded(self, event):
+        pass
+
+    def command_failed(self, event):
+        pass
+
+    def report(self) -> dict:
+        with self.lock:
+            return {"enabled": QUERY_AUDIT, "unprojected": {key: dict(entry) for key, entry in self.unprojected.items()}}
+
+query_audit = QueryAudit()
+
+def create_mongo_client() -> AsyncIOMotorClient:
+    options = {
+        "tz_aware": True,
+        "maxPoolSize": MONGO_MAX_POOL_SIZE,
+        "minPoolSize": MONGO_MIN_POOL_SIZE,
+        "event_listeners": [mongo_pool_metrics] + ([query_audit] if QUERY_AUDIT else [])
+    }
+    if MONGO_WAIT_QUEUE_TIMEOUT_MS > 0:
+        options["waitQueueTimeoutMS"] = MONGO_WAIT_QUEUE_TIMEOUT_MS
+    if MONGO_COMPRESSORS:
+        options["compressors"] = MONGO_COMPRESSORS
+    return AsyncIOMotorClient(os.environ['MONGO_URL'], **options)
+
+client = create_mongo_client()
 db = client[os.environ['DB_NAME']]
 
+# Outbound HTTP: one keep-alive pool shared by every external call
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "20"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "10"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+
+http_client: Optional[httpx.AsyncClient] = None  # opened by the app lifespan
+
+def create_http_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(limits=httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+    ))
+
 # Security
 SECRET_KEY = os.getenv("SECRET_KEY", "campustrack-secret-key-change-in-production")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 1440  # 24 hours
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Password hashing: the bcrypt cost is pinned so hashes made with any other
+# cost are transparently rehashed on the next successful login
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "64"))
+
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+    bcrypt__max_rounds=BCRYPT_ROUNDS
+)
+password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
+password_jobs_pending = 0
 security = HTTPBearer()
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Open shared resources and run the startup steps; release everything on shutdown"""
+    await startup()
+    try:
+        yield
+    finally:
+        await shutdown()
+
 # Create the main app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 api_router = APIRouter(prefix="/api")
 
+# JSON encoding shared by list responses, NDJSON streams and WebSocket
+# payloads. FAST_JSON=true switches to orjson (same output for our documents)
+# and lets list endpoints return Mongo documents without re-validating them
+# through their response_model.
+FAST_JSON = os.getenv("FAST_JSON", "false").lower() == "true" and orjson is not None
+
+def json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+def dumps(value) -> bytes:
+    if FAST_JSON:
+        # "Z" for UTC, matching what the response_model path emits
+        return orjson.dumps(value, default=json_default, option=orjson.OPT_UTC_Z)
+    return json.dumps(value, default=json_default).encode()
+
+class FastJSONResponse(Response):
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return dumps(content)
+
+def model_projection(model) -> dict:
+    """Mongo projection returning exactly the fields of a response model"""
+    return {"_id": 0, **{field: 1 for field in model.model_fields}}
+
+def list_response(docs: List[dict], response: Response):
+    """Return documents projected with model_projection. With FAST_JSON they are
+    encoded as they are, skipping the response_model round trip."""
+    if not FAST_JSON:
+        return docs
+    headers = {key: value for key, value in response.headers.items() if key != "content-length"}
+    return FastJSONResponse(docs, headers=headers)
+
 # WebSocket connection manager
-class ConnectionManager:
+
+def session_channel(session_id: str) -> str:
+    return f"session:{session_id}"
+
+def department_channel(department: str) -> str:
+    return f"department:{department}"
+
+CHANNEL_PREFIXES = ("session:", "department:")
+
+# Fan-out tuning: per-socket outbound queue size, how many messages in a row a
+# socket may miss before it is evicted, and how long a single send may take
+WS_QUEUE_SIZE = int(os.getenv("WS_QUEUE_SIZE", "256"))
+WS_MAX_CONSECUTIVE_DROPS = int(os.getenv("WS_MAX_CONSECUTIVE_DROPS", "32"))
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "10"))
+
+# Event bus: carries channel messages between workers so every process can
+# deliver to the sockets it holds
+BROADCAST_CHANNEL = "*"
+WORKER_ID = str(uuid.uuid4())
+
+def user_channel(user_id: str) -> str:
+    return f"user:{user_id}"
+
+class InMemoryEventBus:
+    """Process-local bus (default). One instance can be shared by several
+    managers to stand in for a broker in tests."""
+    name = "memory"
+
     def __init__(self):
+        self.handlers: List[Callable[[str, dict], Awaitable[None]]] = []
+
+    async def start(self, handler: Callable[[str, dict], Awaitable[None]]):
+        self.handlers.append(handler)
+
+    async def stop(self):
+        self.handlers.clear()
+
+    async def publish(self, channel: str, message: dict):
+        for handler in list(self.handlers):
+            await handler(channel, message)
+
+class MongoEventBus:
+    """Cross-worker bus over a MongoDB change stream (needs a replica set).
+    Publishing delivers locally right away and inserts the event for the
+    other workers; events this worker wrote are filtered out of its stream."""
+    name = "mongo"
+
+    def __init__(self, collection, ttl_seconds: int = 300):
+        self.collection = collection
+        self.ttl_seconds = ttl_seconds
+        self.handler: Optional[Callable[[str, dict], Awaitable[None]]] = None
+        self.task: Optional[asyncio.Task] = None
+
+    async def start(self, handler: Callable[[str, dict], Awaitable[None]]):
+        self.handler = handler
+        await self.collection.create_index("created_at", expireAfterSeconds=self.ttl_seconds)
+        self.task = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def publish(self, channel: str, message: dict):
+        await self.handler(channel, message)
+        await self.collection.insert_one({
+            "origin": WORKER_ID,
+            "channel": channel,
+            "message": message,
+            "created_at": datetime.now(timezone.utc)
+        })
+
+    async def _listen(self):
+        pipeline = [{"$match": {"operationType": "insert", "fullDocument.origin": {"$ne": WORKER_ID}}}]
+        resume_token = None
+        while True:
+            try:
+                async with self.collection.watch(pipeline, resume_after=resume_token) as stream:
+                    async for change in stream:
+                        resume_token = stream.resume_token
+                        event = change["fullDocument"]
+                        await self.handler(event["channel"], event["message"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Event bus stream error: {str(e)}")
+                await asyncio.sleep(1)
+
+class ClientConnection:
+    """One accepted socket with its bounded outbound queue and writer task"""
+    def __init__(self, websocket: WebSocket, user_id: str):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=WS_QUEUE_SIZE)
+        self.writer: Optional[asyncio.Task] = None
+        self.dropped = 0
+        self.consecutive_drops = 0
+
+    def enqueue(self, payload: str) -> bool:
+        try:
+            self.queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            self.consecutive_drops += 1
+            return False
+        self.consecutive_drops = 0
+        return True
+
+class ConnectionManager:
+    def __init__(self, bus=None):
+        self.bus = bus or InMemoryEventBus()
         self.active_connections: Dict[str, List[WebSocket]] = {}
+        self.clients: Dict[WebSocket, ClientConnection] = {}
+        # channel -> sockets subscribed to it, and the reverse index for cleanup
+        self.channels: Dict[str, Set[WebSocket]] = {}
+        self.subscriptions: Dict[WebSocket, Set[str]] = {}
+        # In-process hooks that see every bus message (e.g. cache invalidation)
+        self.listeners: List[Callable[[str, dict], None]] = []
+        self.messages_sent = 0
+        self.messages_dropped = 0
+        self.evictions = 0
 
     async def connect(self, websocket: WebSocket, user_id: str):
         await websocket.accept()
+        client = ClientConnection(websocket, user_id)
+        client.writer = asyncio.create_task(self._writer(client))
+        self.clients[websocket] = client
         if user_id not in self.active_connections:
             self.active_connections[user_id] = []
         self.active_connections[user_id].append(websocket)
 
     def disconnect(self, websocket: WebSocket, user_id: str):
+        for channel in list(self.subscriptions.get(websocket, ())):
+            self.unsubscribe(websocket, channel)
+        self.subscriptions.pop(websocket, None)
+        client = self.clients.pop(websocket, None)
+        if client is not None and client.writer is not None and client.writer is not asyncio.current_task():
+            client.writer.cancel()
         if user_id in self.active_connections:
-            self.active_connections[user_id].remove(websocket)
+            if websocket in self.active_connections[user_id]:
+                self.active_connections[user_id].remove(websocket)
             if not self.active_connections[user_id]:
                 del self.active_connections[user_id]
 
+    def subscribe(self, websocket: WebSocket, channel: str):
+        self.channels.setdefault(channel, set()).add(websocket)
+        self.subscriptions.setdefault(websocket, set()).add(channel)
+
+    def unsubscribe(self, websocket: WebSocket, channel: str):
+        members = self.channels.get(channel)
+        if members is not None:
+            members.discard(websocket)
+            if not members:
+                del self.channels[channel]
+        if websocket in self.subscriptions:
+            self.subscriptions[websocket].discard(channel)
+
+    def subscribe_user(self, user_id: str, channel: str):
+        """Join every open socket of a user to a channel"""
+        for websocket in self.active_connections.get(user_id, []):
+            self.subscribe(websocket, channel)
+
+    async def _writer(self, client: ClientConnection):
+        """Drain one socket's queue; a failed or stalled send evicts the socket"""
+        try:
+            while True:
+                payload = await client.queue.get()
+                await asyncio.wait_for(client.websocket.send_text(payload), WS_SEND_TIMEOUT)
+                self.messages_sent += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.info(f"Evicting websocket for user {client.user_id}: {e!r}")
+            self._evict(client)
+
+    def _evict(self, client: ClientConnection):
+        if client.websocket not in self.clients:
+            return
+        self.evictions += 1
+        self.disconnect(client.websocket, client.user_id)
+        asyncio.create_task(self._close(client.websocket))
+
+    async def _close(self, websocket: WebSocket):
+        try:
+            await websocket.close(code=status.WS_1011_INTERNAL_ERROR)
+        except Exception:
+            pass
+
+    def _fan_out(self, message: dict, websockets):
+        """Serialize once and hand the payload to each socket's queue without waiting"""
+        payload = dumps(message).decode()
+        for websocket in list(websockets):
+            client = self.clients.get(websocket)
+            if client is None:
+                continue
+            if not client.enqueue(payload):
+                self.messages_dropped += 1
+                if client.consecutive_drops >= WS_MAX_CONSECUTIVE_DROPS:
+                    # Permanently behind: stop buffering for it
+                    self._evict(client)
+
+    async def send(self, websocket: WebSocket, message: dict):
+        self._fan_out(message, [websocket])
+
+    async def start(self):
+        await self.bus.start(self.deliver)
+
+    async def stop(self):
+        await self.bus.stop()
+
+    def add_listener(self, listener: Callable[[str, dict], None]):
+        self.listeners.append(listener)
+
+    async def deliver(self, channel: str, message: dict):
+        """Hand a bus message to the listeners and sockets this process holds"""
+        for listener in self.listeners:
+            listener(channel, message)
+        if channel == BROADCAST_CHANNEL:
+            self._fan_out(message, self.clients.keys())
+        elif channel.startswith("user:"):
+            self._fan_out(message, self.active_connections.get(channel[len("user:"):], []))
+        else:
+            self._fan_out(message, self.channels.get(channel, ()))
+
     async def send_personal_message(self, message: dict, user_id: str):
-        if user_id in self.active_connections:
-            for connection in self.active_connections[user_id]:
-                try:
-                    await connection.send_json(message)
-                except:
-                    pass
+        await self.bus.publish(user_channel(user_id), message)
 
     async def broadcast(self, message: dict):
-        for user_connections in self.active_connections.values():
-            for connection in user_connections:
-                try:
-                    await connection.send_json(message)
-                except:
-                    pass
+        await self.bus.publish(BROADCAST_CHANNEL, message)
+
+    async def send_to_channel(self, message: dict, channel: str):
+        await self.bus.publish(channel, message)
 
     async def broadcast_to_session(self, message: dict, session_id: str):
-        # Broadcast to all users
-        await self.broadcast(message)
+        await self.send_to_channel(message, session_channel(session_id))
+
+    async def broadcast_to_department(self, message: dict, department: str):
+        await self.send_to_channel(message, department_channel(department))
+
+    def metrics(self) -> dict:
+        depths = [client.queue.qsize() for client in self.clients.values()]
+        return {
+            "bus": self.bus.name,
+            "connections": len(self.clients),
+            "users": len(self.active_connections),
+            "channels": len(self.channels),
+            "queue_depth_total": sum(depths),
+            "queue_depth_max": max(depths, default=0),
+            "queue_capacity": WS_QUEUE_SIZE,
+            "messages_sent": self.messages_sent,
+            "messages_dropped": self.messages_dropped,
+            "evictions": self.evictions
+        }
+
+def create_event_bus():
+    if os.getenv("EVENT_BUS", "memory") == "mongo":
+        return MongoEventBus(db.ws_events)
+    return InMemoryEventBus()
+
+manager = ConnectionManager(create_event_bus())
+
+# Check-ins landing within one window are folded into a single
+# attendance_marked message per session (0 disables coalescing)
+ATTENDANCE_COALESCE_MS = int(os.getenv("ATTENDANCE_COALESCE_MS", "150"))
+
+class AttendanceEventCoalescer:
+    """Batches attendance_marked events per session into one message per window"""
+    def __init__(self, manager: ConnectionManager, window_ms: int):
+        self.manager = manager
+        self.window = window_ms / 1000
+        self.pending: Dict[str, dict] = {}
+        self.timers: Dict[str, asyncio.Task] = {}
+        self.events_in = 0
+        self.messages_out = 0
+
+    async def add(self, session: dict, student_ids: List[str], student_names: List[str], present_count: int):
+        session_id = session["id"]
+        self.events_in += len(student_names)
+        batch = self.pending.get(session_id)
+        if batch is None:
+            batch = self.pending[session_id] = {
+                "department": session["department"],
+                "faculty_id": session["faculty_id"],
+                "student_ids": [],
+                "student_names": [],
+                "present_count": 0
+            }
+            if self.window > 0:
+                self.timers[session_id] = asyncio.create_task(self._flush_later(session_id))
+        batch["student_ids"].extend(student_ids)
+        batch["student_names"].extend(student_names)
+        batch["present_count"] = max(batch["present_count"], present_count)
+        if self.window <= 0:
+            await self.flush(session_id)
+
+    async def _flush_later(self, session_id: str):
+        await asyncio.sleep(self.window)
+        self.timers.pop(session_id, None)
+        await self.flush(session_id)
+
+    async def flush(self, session_id: str):
+        batch = self.pending.pop(session_id, None)
+        if not batch:
+            return
+        self.messages_out += 1
+        await self.manager.broadcast_to_session({
+            "type": "attendance_marked",
+            "session_id": session_id,
+            "department": batch["department"],
+            "faculty_id": batch["faculty_id"],
+            "student_ids": batch["student_ids"],
+            "student_name": batch["student_names"][-1],
+            "student_names": batch["student_names"],
+            "present_count": batch["present_count"]
+        }, session_id)
 
-manager = ConnectionManager()
+    async def flush_all(self):
+        for timer in self.timers.values():
+            timer.cancel()
+        self.timers.clear()
+        for session_id in list(self.pending):
+            await self.flush(session_id)
+
+    def metrics(self) -> dict:
+        return {
+            "window_ms": int(self.window * 1000),
+            "pending_sessions": len(self.pending),
+            "events_in": self.events_in,
+            "messages_out": self.messages_out
+        }
+
+attendance_events = AttendanceEventCoalescer(manager, ATTENDANCE_COALESCE_MS)
 
 # Models
 class User(BaseModel):
@@ -86,6 +612,8 @@ class User(BaseModel):
     student_id: Optional[str] = None
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
+USER_PROJECTION = model_projection(User)
+
 class UserCreate(BaseModel):
     email: EmailStr
     password: str
@@ -136,9 +664,31 @@ class Attendance(BaseModel):
     confidence_score: float = 0.95
     location: Optional[str] = None
 
+SESSION_PROJECTION = model_projection(Session)
+ATTENDANCE_PROJECTION = model_projection(Attendance)
+
 class AttendanceCreate(BaseModel):
     session_id: str
     verification_method: str = "face"
+    qr_token: Optional[str] = None  # required when verification_method is "qr"
+
+class OfflineCheckIn(BaseModel):
+    client_id: str  # generated by the client; makes retries idempotent
+    session_id: str
+    captured_at: str  # ISO 8601, exactly as signed
+    qr_token: str  # rotating QR token scanned in the room at captured_at
+    signature: str  # hex HMAC-SHA256 of "client_id|session_id|captured_at|qr_token"
+
+class OfflineSyncRequest(BaseModel):
+    check_ins: List[OfflineCheckIn]
+
+class BulkAttendanceRecord(BaseModel):
+    session_id: str
+    student_id: str  # user id or student roll number
+
+class BulkAttendanceCreate(BaseModel):
+    records: List[BulkAttendanceRecord]
+    verification_method: Literal["manual", "qr"] = "manual"
 
 # Helper functions
 def verify_password(plain_password, hashed_password):
@@ -147,6 +697,22 @@ def verify_password(plain_password, hashed_password):
 def get_password_hash(password):
     return pwd_context.hash(password)
 
+async def run_password_job(func, *args):
+    """Run bcrypt work on the bounded password pool instead of the event loop.
+    Sheds load with a 503 once PASSWORD_HASH_MAX_PENDING jobs are queued."""
+    global password_jobs_pending
+    if password_jobs_pending >= PASSWORD_HASH_MAX_PENDING:
+        raise HTTPException(
+            status_code=503,
+            detail="Authentication service busy, please retry",
+            headers={"Retry-After": "1"}
+        )
+    password_jobs_pending += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(password_executor, func, *args)
+    finally:
+        password_jobs_pending -= 1
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -157,6 +723,195 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+class TTLCache:
+    """Small in-process LRU cache whose entries expire after `ttl` seconds"""
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value, ttl: Optional[float] = None):
+        if self.maxsize <= 0:
+            return
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self.entries[key] = (expires, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def metrics(self) -> dict:
+        return {"size": len(self.entries), "maxsize": self.maxsize, "ttl": self.ttl, "hits": self.hits, "misses": self.misses}
+
+# Authenticated users by id, and decoded tokens by token hash (0 size disables).
+# Nothing updates the cached profile fields after registration, so entries are
+# only ever bounded by USER_CACHE_TTL; any endpoint that starts editing users
+# must drop the entry (and tell the other workers) when it lands.
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+
+user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+token_cache = TTLCache(TOKEN_CACHE_SIZE, USER_CACHE_TTL)
+
+# Active sessions by id as compact records for the check-in path. Sessions
+# only change shape when they end, so entries are dropped by end_session here
+# and by its session_ended event on other workers; the TTL bounds staleness
+# when events don't cross processes (EVENT_BUS=memory with several workers)
+ACTIVE_SESSION_CACHE_SIZE = int(os.getenv("ACTIVE_SESSION_CACHE_SIZE", "10000"))
+ACTIVE_SESSION_CACHE_TTL = float(os.getenv("ACTIVE_SESSION_CACHE_TTL", "30"))
+SESSION_RECORD_PROJECTION = {"_id": 0, "id": 1, "is_active": 1, "course_code": 1, "faculty_id": 1, "department": 1}
+
+active_session_cache = TTLCache(ACTIVE_SESSION_CACHE_SIZE, ACTIVE_SESSION_CACHE_TTL)
+
+def cache_active_session(session: dict):
+    if session.get("is_active"):
+        active_session_cache.set(session["id"], {field: session[field] for field in SESSION_RECORD_PROJECTION if field != "_id"})
+
+async def get_session_record(session_id: str) -> Optional[dict]:
+    """id, is_active, course_code, faculty_id and department of a session;
+    active sessions are served from the cache"""
+    record = active_session_cache.get(session_id)
+    if record is not None:
+        return record
+    record = await db.sessions.find_one({"id": session_id}, SESSION_RECORD_PROJECTION)
+    if record:
+        cache_active_session(record)
+    return record
+
+def track_session_events(channel: str, message: dict):
+    if message.get("type") == "session_created":
+        cache_active_session(message["session"])
+    elif message.get("type") == "session_ended":
+        active_session_cache.invalidate(message["session_id"])
+
+manager.add_listener(track_session_events)
+
+# Conditional GETs for polled reads. Each response depends on a few scopes
+# ("global", "department:<name>", "faculty:<id>", "user:<id>") whose version
+# counters writes bump; the ETag hashes those versions with the URL, so an
+# unchanged dashboard is answered with a 304 before any query runs. With one
+# worker the counters live in memory; with EVENT_BUS=mongo (several workers)
+# they live in the `response_versions` collection, so every worker derives
+# the same ETag and a write on one is seen by all. The time bucket bounds how
+# long a missed bump can go unnoticed.
+RESPONSE_ETAG_MAX_AGE = int(os.getenv("RESPONSE_ETAG_MAX_AGE", "30"))
+RESPONSE_CACHE_CONTROL = "private, no-cache"
+ALL_SCOPES = "*"
+
+class ResponseVersions:
+    """In-process scope versions (single worker)"""
+    def __init__(self):
+        self.versions: Dict[str, int] = {}
+        self.not_modified = 0
+        self.etags_issued = 0
+
+    async def bump(self, *scopes: str):
+        for scope in scopes:
+            self.versions[scope] = self.versions.get(scope, 0) + 1
+
+    async def bump_all(self):
+        """Invalidate every scope, e.g. after a repair job rewrote data"""
+        await self.bump(ALL_SCOPES)
+
+    async def get_versions(self, scopes: List[str]) -> Dict[str, int]:
+        return {scope: self.versions.get(scope, 0) for scope in scopes}
+
+    async def etag(self, request: Request, scopes: List[str]) -> str:
+        versions = await self.get_versions([ALL_SCOPES] + scopes)
+        bucket = int(time.time() // RESPONSE_ETAG_MAX_AGE) if RESPONSE_ETAG_MAX_AGE > 0 else 0
+        state = "|".join([str(bucket), str(request.url.path), request.url.query]
+                         + [f"{scope}={versions.get(scope, 0)}" for scope in [ALL_SCOPES] + scopes])
+        return f'W/"{hashlib.sha1(state.encode()).hexdigest()[:24]}"'
+
+    async def check(self, request: Request, response: Response, scopes: List[str]) -> Optional[Response]:
+        """304 response if the client's copy is current; otherwise tag `response` and return None.
+        The tag is taken before the read, so a write racing it only costs a refetch."""
+        etag = await self.etag(request, scopes)
+        headers = {"ETag": etag, "Cache-Control": RESPONSE_CACHE_CONTROL}
+        if etag in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]:
+            self.not_modified += 1
+            return Response(status_code=304, headers=headers)
+        self.etags_issued += 1
+        response.headers.update(headers)
+        return None
+
+    def metrics(self) -> dict:
+        return {"scopes": len(self.versions), "etags_issued": self.etags_issued, "not_modified": self.not_modified}
+
+class SharedResponseVersions(ResponseVersions):
+    """Scope versions in MongoDB, shared by every worker: one upsert per
+    write and one _id lookup per conditional GET"""
+    def __init__(self, collection):
+        super().__init__()
+        self.collection = collection
+
+    async def bump(self, *scopes: str):
+        if scopes:
+            await self.collection.bulk_write(
+                [UpdateOne({"_id": scope}, {"$inc": {"v": 1}}, upsert=True) for scope in set(scopes)],
+                ordered=False
+            )
+
+    async def get_versions(self, scopes: List[str]) -> Dict[str, int]:
+        docs = await self.collection.find({"_id": {"$in": scopes}}, {"v": 1}).to_list(len(scopes))
+        return {doc["_id"]: doc["v"] for doc in docs}
+
+    def metrics(self) -> dict:
+        return {"shared": True, "etags_issued": self.etags_issued, "not_modified": self.not_modified}
+
+def create_response_versions() -> ResponseVersions:
+    if os.getenv("EVENT_BUS", "memory") == "mongo":
+        return SharedResponseVersions(db.response_versions)
+    return ResponseVersions()
+
+response_versions = create_response_versions()
+
+def session_scopes(session: dict) -> List[str]:
+    """Scopes whose reads include this session (lists, overviews)"""
+    return ["global", f"department:{session['department']}", f"faculty:{session['faculty_id']}"]
+
+def reader_scopes(current_user: User) -> List[str]:
+    """Scope of the sessions a user can list"""
+    if current_user.role == "student":
+        return [f"department:{current_user.department}"]
+    if current_user.role == "faculty":
+        return [f"faculty:{current_user.id}"]
+    return ["global"]
+
+def decode_token_user_id(token: str) -> Optional[str]:
+    token_key = hashlib.sha256(token.encode()).digest()
+    cached = token_cache.get(token_key)
+    if cached is not None:
+        return cached
+    
+    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    user_id = payload.get("sub")
+    if user_id is not None:
+        # Never keep a token cached past its own expiry
+        remaining = payload.get("exp", 0) - time.time()
+        if remaining > 0:
+            token_cache.set(token_key, user_id, ttl=min(token_cache.ttl, remaining))
+    return user_id
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -164,46 +919,198 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        token = credentials.credentials
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id: str = payload.get("sub")
+        user_id = decode_token_user_id(credentials.credentials)
         if user_id is None:
             raise credentials_exception
     except JWTError:
         raise credentials_exception
     
-    user = await db.users.find_one({"id": user_id}, {"_id": 0})
+    cached_user = user_cache.get(user_id)
+    if cached_user is not None:
+        return cached_user
+    
+    user = await db.users.find_one({"id": user_id}, USER_PROJECTION)
     if user is None:
         raise credentials_exception
     
-    if isinstance(user.get('created_at'), str):
-        user['created_at'] = datetime.fromisoformat(user['created_at'])
+    current_user = User(**user)
+    user_cache.set(user_id, current_user)
+    return current_user
+
+# Face verification: check-ins are queued, grouped into micro-batches and
+# scored on a process pool by a pluggable backend. The pool is created at
+# startup with a start method that does not fork the threaded server process,
+# and by default the cores are split across the uvicorn workers
+# (WEB_CONCURRENCY is the variable uvicorn reads for --workers).
+WEB_CONCURRENCY = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+FACE_BACKEND = os.getenv("FACE_BACKEND", "simulated")
+FACE_WORKERS = int(os.getenv("FACE_WORKERS", str(max(1, (os.cpu_count() or 1) // WEB_CONCURRENCY))))
+FACE_START_METHOD = os.getenv("FACE_START_METHOD", "spawn")  # spawn or forkserver
+FACE_BATCH_SIZE = int(os.getenv("FACE_BATCH_SIZE", "32"))
+FACE_BATCH_WAIT_MS = int(os.getenv("FACE_BATCH_WAIT_MS", "20"))
+FACE_MATCH_THRESHOLD = float(os.getenv("FACE_MATCH_THRESHOLD", "0.8"))
+FACE_EMBEDDING_DIM = 128
+
+def simulate_face_recognition(student_ids: List[str]) -> List[dict]:
+    """Mock model: compares a noisy probe embedding against each student's
+    enrolled embedding, vectorized over the whole batch"""
+    import numpy as np
     
-    return User(**user)
+    enrolled = np.stack([
+        np.random.default_rng(int.from_bytes(hashlib.sha256(student_id.encode()).digest()[:8], "big")).standard_normal(FACE_EMBEDDING_DIM)
+        for student_id in student_ids
+    ])
+    probes = enrolled + np.random.default_rng().normal(0, 0.3, enrolled.shape)
+    similarity = np.einsum("ij,ij->i", enrolled, probes) / (
+        np.linalg.norm(enrolled, axis=1) * np.linalg.norm(probes, axis=1)
+    )
+    return [
+        {
+            "success": bool(score >= FACE_MATCH_THRESHOLD),
+            "confidence": round(float(score), 2),
+            "matched_id": student_id,
+            "liveness_check": True
+        }
+        for student_id, score in zip(student_ids, similarity)
+    ]
 
-# Mock AI face recognition
-async def simulate_face_recognition(student_id: str) -> dict:
-    """Simulates face recognition with random confidence"""
-    import random
-    await asyncio.sleep(0.5)  # Simulate processing time
-    return {
-        "success": True,
-        "confidence": round(random.uniform(0.92, 0.99), 2),
-        "matched_id": student_id,
-        "liveness_check": True
-    }
+def load_face_backend(name: str) -> Callable[[List[str]], List[dict]]:
+    """Resolve "simulated" or a "package.module:function" batch verifier"""
+    if name == "simulated":
+        return simulate_face_recognition
+    module_name, _, func_name = name.partition(":")
+    return getattr(importlib.import_module(module_name), func_name)
+
+class FaceVerificationQueue:
+    def __init__(self, backend: Callable[[List[str]], List[dict]], workers: int, batch_size: int, batch_wait_ms: int, start_method: str):
+        self.backend = backend
+        self.workers = max(1, workers)
+        self.start_method = start_method
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait_ms / 1000
+        self.queue: Optional[asyncio.Queue] = None
+        self.executor: Optional[ProcessPoolExecutor] = None
+        self.dispatcher: Optional[asyncio.Task] = None
+        self.in_flight: Optional[asyncio.Semaphore] = None
+        self.batches = 0
+        self.verified = 0
+        self.pool_restarts = 0
+
+    async def start(self):
+        if self.dispatcher is not None:
+            return
+        self.queue = asyncio.Queue()
+        self.in_flight = asyncio.Semaphore(self.workers)
+        self.executor = self._create_executor()
+        self.dispatcher = asyncio.create_task(self._dispatch())
+
+    def _create_executor(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=multiprocessing.get_context(self.start_method)
+        )
+
+    def _replace_broken(self, executor: ProcessPoolExecutor):
+        """Swap in a fresh pool once per broken one (other batches may race here)"""
+        if self.executor is executor:
+            logger.warning("Face verification pool broke (a worker died); starting a new one")
+            executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = self._create_executor()
+            self.pool_restarts += 1
+
+    async def stop(self):
+        if self.dispatcher is not None:
+            self.dispatcher.cancel()
+            self.dispatcher = None
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    async def verify(self, student_id: str) -> dict:
+        if self.dispatcher is None:
+            raise RuntimeError("Face verification queue is not running")
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((student_id, future))
+        return await future
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.batch_wait
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # One batch per worker in flight; the rest keep accumulating
+            await self.in_flight.acquire()
+            asyncio.create_task(self._run_batch(batch))
+
+    async def _run_batch(self, batch: list):
+        student_ids = [student_id for student_id, _ in batch]
+        try:
+            # A dead worker breaks the whole pool; replace it and retry once
+            for attempt in range(2):
+                executor = self.executor
+                try:
+                    results = await asyncio.get_running_loop().run_in_executor(executor, self.backend, student_ids)
+                    break
+                except BrokenProcessPool:
+                    self._replace_broken(executor)
+                    if attempt:
+                        raise
+            self.batches += 1
+            self.verified += len(batch)
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            self.in_flight.release()
+
+    def metrics(self) -> dict:
+        return {
+            "backend": FACE_BACKEND,
+            "workers": self.workers,
+            "start_method": self.start_method,
+            "queued": self.queue.qsize() if self.queue is not None else 0,
+            "batches": self.batches,
+            "verified": self.verified,
+            "pool_restarts": self.pool_restarts
+        }
+
+face_verifier = FaceVerificationQueue(
+    load_face_backend(FACE_BACKEND), FACE_WORKERS, FACE_BATCH_SIZE, FACE_BATCH_WAIT_MS, FACE_START_METHOD
+)
+
+# Outcome of check-ins accepted with 202, kept long enough for clients to poll
+verification_jobs = TTLCache(100000, 600)
+check_in_tasks: Set[asyncio.Task] = set()
 
 # AI Analytics using OpenRouter
-async def get_ai_insights(attendance_data: list) -> dict:
-    """Get AI-powered insights using OpenRouter API"""
+# LLM endpoint: any OpenAI-compatible chat completions URL, so a local stub can
+# stand in for OpenRouter (the API key is only required for the default URL)
+DEFAULT_LLM_API_URL = "https://openrouter.ai/api/v1/chat/completions"
+LLM_API_URL = os.getenv("LLM_API_URL", DEFAULT_LLM_API_URL)
+LLM_MODEL = os.getenv("LLM_MODEL", "deepseek/deepseek-chat-v3.1:free")
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "30"))
+
+async def get_ai_insights(attendance_data: list) -> Tuple[str, bool]:
+    """Get AI-powered insights using the configured LLM; returns (text, succeeded)"""
     try:
         api_key = os.getenv("OPENROUTER_API_KEY")
-        if not api_key:
-            return {"insights": "AI insights unavailable - API key not configured"}
+        if not api_key and LLM_API_URL == DEFAULT_LLM_API_URL:
+            return "AI insights unavailable - API key not configured", False
         
         # Prepare data summary
-        total_sessions = len(attendance_data)
-        avg_attendance = sum(d.get('attendance_rate', 0) for d in attendance_data) / total_sessions if total_sessions > 0 else 0
+        total_sessions = sum(d.get('sessions', 1) for d in attendance_data)
+        avg_attendance = sum(d.get('attendance_rate', 0) for d in attendance_data) / len(attendance_data) if attendance_data else 0
         
         prompt = f"""Analyze this attendance data and provide brief insights:
         Total Sessions: {total_sessions}
@@ -211,28 +1118,754 @@ async def get_ai_insights(attendance_data: list) -> dict:
         
         Provide 3-4 bullet points with actionable insights about attendance patterns and recommendations."""
         
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(
-                "https://openrouter.ai/api/v1/chat/completions",
-                headers={
-                    "Authorization": f"Bearer {api_key}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "model": "deepseek/deepseek-chat-v3.1:free",
-                    "messages": [{"role": "user", "content": prompt}]
-                }
-            )
-            
-            if response.status_code == 200:
-                data = response.json()
-                insights = data.get("choices", [{}])[0].get("message", {}).get("content", "")
-                return {"insights": insights}
-            else:
-                return {"insights": "AI insights temporarily unavailable"}
+        headers = {"Content-Type": "application/json"}
+        if api_key:
+            headers["Authorization"] = f"Bearer {api_key}"
+        response = await http_client.post(
+            LLM_API_URL,
+            headers=headers,
+            json={
+                "model": LLM_MODEL,
+                "messages": [{"role": "user", "content": prompt}]
+            },
+            timeout=LLM_TIMEOUT
+        )
+        
+        if response.status_code == 200:
+            data = response.json()
+            insights = data.get("choices", [{}])[0].get("message", {}).get("content", "")
+            return insights, True
+        return "AI insights temporarily unavailable", False
     except Exception as e:
         logger.error(f"AI insights error: {str(e)}")
-        return {"insights": "AI insights temporarily unavailable"}
+        return "AI insights temporarily unavailable", False
+
+async def collect_insights_data() -> list:
+    """Per-course figures the insights prompt is built from"""
+    courses = await db.rollups.find(
+        {"_id": {"$regex": "^course:"}},
+        {"_id": 1, "sessions": 1, "attendance": 1, "total_rate": 1, "ended_sessions": 1}
+    ).limit(50).to_list(50)
+    return [
+        {
+            "course_code": course["_id"][len("course:"):],
+            "sessions": course.get("sessions", 0),
+            "attendance_count": course.get("attendance", 0),
+            "attendance_rate": (course.get("total_rate", 0) / course["ended_sessions"]) if course.get("ended_sessions") else 0
+        }
+        for course in courses
+    ]
+
+# AI insights are generated off the request path and cached per scope. An
+# expired entry is still served while one background refresh replaces it,
+# concurrent misses share that refresh, and failures are retried sooner.
+# Only scopes read since the last period are refreshed in the background, so
+# an idle worker never calls the LLM.
+AI_INSIGHTS_TTL = float(os.getenv("AI_INSIGHTS_TTL", "900"))
+AI_INSIGHTS_RETRY_SECONDS = float(os.getenv("AI_INSIGHTS_RETRY_SECONDS", "60"))
+AI_INSIGHTS_WAIT_SECONDS = float(os.getenv("AI_INSIGHTS_WAIT_SECONDS", "5"))
+# Insights are built from the global course rollups, so faculty and admins
+# currently share one scope
+AI_INSIGHTS_SCOPE = "courses"
+
+class InsightsCache:
+    def __init__(self):
+        self.entries: Dict[str, dict] = {}
+        self.refreshing: Dict[str, asyncio.Task] = {}
+        self.requested: Set[str] = set()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+
+    def refresh(self, scope: str) -> asyncio.Task:
+        """Start a refresh for the scope unless one is already running"""
+        task = self.refreshing.get(scope)
+        if task is None:
+            task = asyncio.create_task(self._refresh(scope))
+            self.refreshing[scope] = task
+            task.add_done_callback(lambda _: self.refreshing.pop(scope, None))
+        return task
+
+    async def _refresh(self, scope: str) -> dict:
+        self.refreshes += 1
+        insights, succeeded = await get_ai_insights(await collect_insights_data())
+        entry = {
+            "insights": insights,
+            "generated_at": datetime.now(timezone.utc),
+            "expires": time.monotonic() + (AI_INSIGHTS_TTL if succeeded else AI_INSIGHTS_RETRY_SECONDS)
+        }
+        self.entries[scope] = entry
+        return entry
+
+    async def get(self, scope: str) -> dict:
+        self.requested.add(scope)
+        entry = self.entries.get(scope)
+        if entry is None:
+            self.misses += 1
+            try:
+                entry = await asyncio.wait_for(asyncio.shield(self.refresh(scope)), AI_INSIGHTS_WAIT_SECONDS)
+            except asyncio.TimeoutError:
+                return {"insights": "AI insights are being generated", "generated_at": None}
+        elif entry["expires"] < time.monotonic():
+            self.stale_hits += 1
+            self.refresh(scope)
+        else:
+            self.hits += 1
+        return {"insights": entry["insights"], "generated_at": entry["generated_at"]}
+
+    async def refresh_periodically(self):
+        """Keep the scopes read during the last period warm"""
+        while True:
+            await asyncio.sleep(AI_INSIGHTS_TTL)
+            scopes, self.requested = self.requested, set()
+            for scope in scopes:
+                try:
+                    await self.refresh(scope)
+                except Exception as e:
+                    logger.error(f"AI insights refresh error: {str(e)}")
+
+    def stop(self):
+        for task in list(self.refreshing.values()):
+            task.cancel()
+
+    def metrics(self) -> dict:
+        return {
+            "scopes": len(self.entries),
+            "ttl": AI_INSIGHTS_TTL,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+            "in_flight": len(self.refreshing)
+        }
+
+ai_insights = InsightsCache()
+
+# present_count is maintained with $inc on each successful insert; this job
+# recounts from the attendance collection and repairs any drift. A check-in
+# between its insert and its $inc looks like drift for a moment, so a session
+# is only repaired when the same drift is seen on two reads
+# PRESENT_COUNT_SETTLE_SECONDS apart. Sessions that ended within the last two
+# intervals are rechecked too, since late check-ins land around end_session.
+PRESENT_COUNT_RECONCILE_SECONDS = int(os.getenv("PRESENT_COUNT_RECONCILE_SECONDS", "300"))
+PRESENT_COUNT_SETTLE_SECONDS = float(os.getenv("PRESENT_COUNT_SETTLE_SECONDS", "2"))
+RECONCILE_PROJECTION = {"_id": 0, "id": 1, "present_count": 1, "is_active": 1, "faculty_id": 1, "course_code": 1, "total_students": 1}
+
+async def find_present_count_drift(session_query: dict) -> Dict[str, tuple]:
+    """(session, actual count) for every matching session whose present_count is off"""
+    sessions = await db.sessions.find(session_query, RECONCILE_PROJECTION).to_list(None)
+    if not sessions:
+        return {}
+    
+    counts = {}
+    pipeline = [
+        {"$match": {"session_id": {"$in": [session["id"] for session in sessions]}}},
+        {"$group": {"_id": "$session_id", "count": {"$sum": 1}}}
+    ]
+    async for row in db.attendance.aggregate(pipeline):
+        counts[row["_id"]] = row["count"]
+    return {
+        session["id"]: (session, counts.get(session["id"], 0))
+        for session in sessions
+        if session.get("present_count", 0) != counts.get(session["id"], 0)
+    }
+
+async def reconcile_present_counts(session_query: Optional[dict] = None) -> int:
+    """Recount attendance for the matching sessions and fix drift that persists
+    across two reads; returns the number of sessions repaired"""
+    first = await find_present_count_drift(session_query or {})
+    if not first:
+        return 0
+    await asyncio.sleep(PRESENT_COUNT_SETTLE_SECONDS)
+    second = await find_present_count_drift({"id": {"$in": list(first)}})
+    
+    repaired = 0
+    rollup_updates: Dict[str, Dict[str, float]] = {}
+    for session_id, (session, actual) in second.items():
+        stored = session.get("present_count", 0)
+        previous, previous_actual = first[session_id]
+        if (previous.get("present_count", 0), previous_actual) != (stored, actual):
+            continue  # still moving; look again next run
+        # Only overwrite the value we read; a concurrent $inc wins
+        result = await db.sessions.update_one(
+            {"id": session_id, "present_count": stored},
+            {"$set": {"present_count": actual}}
+        )
+        if not result.modified_count:
+            continue
+        repaired += 1
+        if not session.get("is_active") and session.get("total_students", 0) > 0:
+            # Ended sessions were folded into the rate rollups with the drifted count
+            rate_delta = (actual - stored) / session["total_students"] * 100
+            for key in (f"faculty:{session['faculty_id']}", f"course:{session['course_code']}"):
+                fields = rollup_updates.setdefault(key, {})
+                fields["total_rate"] = fields.get("total_rate", 0) + rate_delta
+    if rollup_updates:
+        await bump_rollups(rollup_updates)
+    if repaired:
+        await response_versions.bump_all()
+        logger.warning(f"Repaired present_count drift on {repaired} session(s)")
+    return repaired
+
+async def reconcile_present_counts_periodically():
+    recent = timedelta(seconds=2 * PRESENT_COUNT_RECONCILE_SECONDS)
+    while True:
+        await asyncio.sleep(PRESENT_COUNT_RECONCILE_SECONDS)
+        try:
+            await reconcile_present_counts({"$or": [
+                {"is_active": True},
+                {"end_time": {"$gte": datetime.now(timezone.utc) - recent}}
+            ]})
+        except Exception as e:
+            logger.error(f"present_count reconciliation error: {str(e)}")
+
+background_tasks: List[asyncio.Task] = []
+
+# Index registry: every index the API relies on, applied idempotently at
+# startup and audited by `python server.py --check-indexes`
+INDEX_REGISTRY: Dict[str, List[dict]] = {
+    "users": [
+        {"keys": [("id", 1)], "name": "id_unique", "unique": True},
+        {"keys": [("email", 1)], "name": "email_unique", "unique": True},
+        {"keys": [("role", 1)], "name": "role"},
+        {"keys": [("student_id", 1)], "name": "student_id"},
+    ],
+    "sessions": [
+        {"keys": [("id", 1)], "name": "id_unique", "unique": True},
+        {"keys": [("faculty_id", 1), ("start_time", -1), ("id", -1)], "name": "faculty_start_time_id"},
+        {"keys": [("department", 1), ("is_active", 1), ("start_time", -1), ("id", -1)], "name": "department_active_start_time_id"},
+        {"keys": [("is_active", 1), ("start_time", -1), ("id", -1)], "name": "active_start_time_id"},
+        {"keys": [("start_time", -1), ("id", -1)], "name": "start_time_id"},
+    ],
+    "attendance": [
+        {"keys": [("session_id", 1), ("student_id", 1)], "name": "session_student_unique", "unique": True, "required": True},
+        {"keys": [("student_id", 1), ("marked_at", -1), ("id", -1)], "name": "student_marked_at_id"},
+        {"keys": [("session_id", 1), ("marked_at", -1), ("id", -1)], "name": "session_marked_at_id"},
+        {"keys": [("client_id", 1)], "name": "client_id_unique", "unique": True, "partialFilterExpression": {"client_id": {"$type": "string"}}, "required": True},
+        {"keys": [("marked_at", -1)], "name": "marked_at"},
+    ],
+}
+
+# Queries behind the hot endpoints; none of them may plan a collection scan
+HOT_QUERIES: List[dict] = [
+    {"endpoint": "get_current_user", "collection": "users", "filter": {"id": ""}},
+    {"endpoint": "login", "collection": "users", "filter": {"email": ""}},
+    {"endpoint": "get_sessions (faculty)", "collection": "sessions", "filter": {"faculty_id": ""}, "sort": [("start_time", -1), ("id", -1)]},
+    {"endpoint": "get_sessions (student)", "collection": "sessions", "filter": {"department": "", "is_active": True}, "sort": [("start_time", -1), ("id", -1)]},
+    {"endpoint": "get_sessions (admin)", "collection": "sessions", "filter": {}, "sort": [("start_time", -1), ("id", -1)]},
+    {"endpoint": "get_session", "collection": "sessions", "filter": {"id": ""}},
+    {"endpoint": "get_my_attendance", "collection": "attendance", "filter": {"student_id": ""}, "sort": [("marked_at", -1), ("id", -1)]},
+    {"endpoint": "get_session_attendance", "collection": "attendance", "filter": {"session_id": ""}, "sort": [("marked_at", -1), ("id", -1)]},
+    # Reads answered from the index alone
+    {"endpoint": "register", "collection": "users", "filter": {"email": ""}, "projection": {"_id": 0, "email": 1}, "covered": True},
+    {"endpoint": "get_attendance_trends (faculty)", "collection": "sessions", "filter": {"faculty_id": ""}, "projection": {"_id": 0, "id": 1}, "covered": True},
+]
+
+async def ensure_indexes():
+    """Create every registered index; existing identical indexes are a no-op.
+    The attendance unique indexes ("required") are what check-ins rely on to
+    detect duplicates, so failing to build one (usually because old data
+    already holds duplicates) stops startup. Other unique indexes only log,
+    with a query to find the duplicates, since merging users or sessions
+    needs a person to decide."""
+    unique_failures = []
+    for collection, specs in INDEX_REGISTRY.items():
+        for spec in specs:
+            try:
+                options = {"partialFilterExpression": spec["partialFilterExpression"]} if "partialFilterExpression" in spec else {}
+                await db[collection].create_index(
+                    spec["keys"],
+                    name=spec["name"],
+                    unique=spec.get("unique", False),
+                    **options
+                )
+            except Exception as e:
+                logger.error(f"Index creation failed for {collection}.{spec['name']}: {str(e)}")
+                if spec.get("required"):
+                    unique_failures.append(f"{collection}.{spec['name']}")
+                elif spec.get("unique"):
+                    group = {field: f"${field}" for field, _ in spec["keys"]}
+                    logger.error(
+                        f"Find the duplicates with db.{collection}.aggregate([{{$group: {{_id: {json.dumps(group)}, n: {{$sum: 1}}}}}}, "
+                        "{$match: {n: {$gt: 1}}}]) and merge or remove them by hand"
+                    )
+    if unique_failures:
+        raise RuntimeError(
+            f"Unique indexes could not be built: {', '.join(unique_failures)}. "
+            "Remove existing duplicates with `python server.py --dedupe-attendance` and restart."
+        )
+
+async def dedupe_attendance() -> dict:
+    """Clear duplicates that block the attendance unique indexes: keep the
+    earliest row per (session, student), and the client_id only on the earliest
+    row carrying it. Counts and rollups are recomputed afterwards."""
+    removed = 0
+    affected_sessions = set()
+    pipeline = [
+        {"$sort": {"marked_at": 1}},
+        {"$group": {"_id": {"session_id": "$session_id", "student_id": "$student_id"}, "ids": {"$push": "$_id"}}},
+        {"$match": {"ids.1": {"$exists": True}}}
+    ]
+    async for group in db.attendance.aggregate(pipeline, allowDiskUse=True):
+        result = await db.attendance.delete_many({"_id": {"$in": group["ids"][1:]}})
+        removed += result.deleted_count
+        affected_sessions.add(group["_id"]["session_id"])
+    
+    cleared = 0
+    pipeline = [
+        {"$match": {"client_id": {"$type": "string"}}},
+        {"$sort": {"marked_at": 1}},
+        {"$group": {"_id": "$client_id", "ids": {"$push": "$_id"}}},
+        {"$match": {"ids.1": {"$exists": True}}}
+    ]
+    async for group in db.attendance.aggregate(pipeline, allowDiskUse=True):
+        result = await db.attendance.update_many({"_id": {"$in": group["ids"][1:]}}, {"$unset": {"client_id": ""}})
+        cleared += result.modified_count
+    
+    if removed:
+        counts = {}
+        async for row in db.attendance.aggregate([
+            {"$match": {"session_id": {"$in": list(affected_sessions)}}},
+            {"$group": {"_id": "$session_id", "count": {"$sum": 1}}}
+        ]):
+            counts[row["_id"]] = row["count"]
+        await db.sessions.bulk_write(
+            [UpdateOne({"id": session_id}, {"$set": {"present_count": counts.get(session_id, 0)}}) for session_id in affected_sessions],
+            ordered=False
+        )
+        await rebuild_rollups()
+    return {"duplicate_rows_removed": removed, "client_ids_cleared": cleared}
+
+def _plan_stages(plan) -> List[str]:
+    if isinstance(plan, dict):
+        stages = [plan["stage"]] if "stage" in plan else []
+        for value in plan.values():
+            stages.extend(_plan_stages(value))
+        return stages
+    if isinstance(plan, list):
+        return [stage for item in plan for stage in _plan_stages(item)]
+    return []
+
+async def check_indexes() -> dict:
+    """Report registered indexes that are missing or unused, indexes outside the
+    registry, hot queries whose winning plan is a collection scan, and
+    covered reads that still fetch documents"""
+    report = {"missing": [], "unregistered": [], "unused": [], "collection_scans": [], "uncovered": []}
+    for collection, specs in INDEX_REGISTRY.items():
+        existing = await db[collection].index_information()
+        registered = {spec["name"] for spec in specs}
+        for spec in specs:
+            if spec["name"] not in existing:
+                report["missing"].append(f"{collection}.{spec['name']}")
+        for name in existing:
+            if name != "_id_" and name not in registered:
+                report["unregistered"].append(f"{collection}.{name}")
+        try:
+            async for stats in db[collection].aggregate([{"$indexStats": {}}]):
+                if stats["name"] in registered and stats["accesses"]["ops"] == 0:
+                    report["unused"].append(f"{collection}.{stats['name']}")
+        except Exception as e:
+            logger.info(f"$indexStats unavailable for {collection}: {str(e)}")
+    
+    for query in HOT_QUERIES:
+        cursor = db[query["collection"]].find(query["filter"], query.get("projection"))
+        if query.get("sort"):
+            cursor = cursor.sort(query["sort"])
+        explain = await cursor.explain()
+        stages = _plan_stages(explain.get("queryPlanner", {}).get("winningPlan", {}))
+        if "COLLSCAN" in stages:
+            report["collection_scans"].append(query["endpoint"])
+        elif query.get("covered") and "FETCH" in stages:
+            report["uncovered"].append(query["endpoint"])
+    return report
+
+# Timestamps used to be stored as isoformat() strings. This migration rewrites
+# them as native dates in _id order, checkpointing in `migrations` so an
+# interrupted run resumes where it stopped.
+DATE_FIELDS: Dict[str, List[str]] = {
+    "users": ["created_at"],
+    "sessions": ["start_time", "end_time", "created_at"],
+    "attendance": ["marked_at"],
+}
+
+def parse_timestamp(value: str) -> datetime:
+    parsed = datetime.fromisoformat(value)
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+async def migrate_dates_to_native(batch_size: int = 1000) -> int:
+    """Convert string timestamps to BSON dates; returns the number of documents updated"""
+    converted = 0
+    for collection, fields in DATE_FIELDS.items():
+        checkpoint_id = f"native_dates:{collection}"
+        checkpoint = await db.migrations.find_one({"_id": checkpoint_id}, {"done": 1, "last_id": 1}) or {}
+        if checkpoint.get("done"):
+            continue
+        
+        query = {"$or": [{field: {"$type": "string"}} for field in fields]}
+        last_id = checkpoint.get("last_id")
+        while True:
+            batch_query = {**query, "_id": {"$gt": last_id}} if last_id is not None else query
+            docs = await db[collection].find(batch_query, {field: 1 for field in fields}).sort("_id", 1).to_list(batch_size)
+            if not docs:
+                break
+            
+            updates = []
+            for doc in docs:
+                changes = {}
+                for field in fields:
+                    if isinstance(doc.get(field), str):
+                        try:
+                            changes[field] = parse_timestamp(doc[field])
+                        except ValueError:
+                            logger.warning(f"Unparseable {collection}.{field} on {doc['_id']}: {doc[field]!r}")
+                if changes:
+                    updates.append(UpdateOne({"_id": doc["_id"]}, {"$set": changes}))
+            if updates:
+                await db[collection].bulk_write(updates, ordered=False)
+                converted += len(updates)
+            
+            last_id = docs[-1]["_id"]
+            await db.migrations.update_one({"_id": checkpoint_id}, {"$set": {"last_id": last_id}}, upsert=True)
+        
+        await db.migrations.update_one({"_id": checkpoint_id}, {"$set": {"done": True}}, upsert=True)
+        logger.info(f"Native date migration finished for {collection}")
+    return converted
+
+# Materialized rollups: dashboard counters kept in the `rollups` collection
+# and bumped with $inc as users, sessions and check-ins change. Documents:
+#   global                     user/session/attendance totals
+#   student:<id>               attended
+#   faculty:<id>               total_sessions, active_sessions, total_rate
+#   department:<name>          ended_sessions
+#   course:<code>              sessions, ended_sessions, attendance, total_rate
+#   day:<scope>:<YYYY-MM-DD>   count, for scope all | student:<id> | faculty:<id>
+ROLE_COUNTERS = {"student": "total_students", "faculty": "total_faculty"}
+
+def day_rollup_keys(day: str, student_id: str, faculty_id: str) -> List[str]:
+    return [f"day:all:{day}", f"day:student:{student_id}:{day}", f"day:faculty:{faculty_id}:{day}"]
+
+def add_attendance_rollups(updates: Dict[str, Dict[str, float]], attendance: Attendance, faculty_id: str):
+    """Accumulate the rollup deltas for one new attendance record"""
+    keys = [
+        ("global", "total_attendance_records"),
+        (f"student:{attendance.student_id}", "attended"),
+        (f"course:{attendance.course_code}", "attendance")
+    ]
+    keys += [(key, "count") for key in day_rollup_keys(attendance.marked_at.date().isoformat(), attendance.student_id, faculty_id)]
+    for key, field in keys:
+        fields = updates.setdefault(key, {})
+        fields[field] = fields.get(field, 0) + 1
+
+def session_rate(session: dict) -> float:
+    total_students = session.get("total_students", 0)
+    return (session.get("present_count", 0) / total_students * 100) if total_students > 0 else 0
+
+async def bump_rollups(updates: Dict[str, Dict[str, float]]):
+    """Apply $inc deltas to several rollup documents in one round-trip"""
+    await db.rollups.bulk_write(
+        [UpdateOne({"_id": key}, {"$inc": inc}, upsert=True) for key, inc in updates.items()],
+        ordered=False
+    )
+
+async def get_rollups(keys: List[str], fields: List[str]) -> Dict[str, dict]:
+    """The given counters of each rollup document, by key"""
+    docs = await db.rollups.find({"_id": {"$in": keys}}, {"_id": 1, **{field: 1 for field in fields}}).to_list(len(keys))
+    return {doc["_id"]: doc for doc in docs}
+
+def session_rate_expr() -> dict:
+    """session_rate() as an aggregation expression"""
+    return {"$cond": [
+        {"$gt": [{"$ifNull": ["$total_students", 0]}, 0]},
+        {"$multiply": [{"$divide": [{"$ifNull": ["$present_count", 0]}, "$total_students"]}, 100]},
+        0
+    ]}
+
+def rollup_merge(staging: str) -> dict:
+    # Each pipeline below writes its own fields, so merging whole documents
+    # never overwrites a counter computed by another one
+    return {"$merge": {"into": staging, "on": "_id", "whenMatched": "merge", "whenNotMatched": "insert"}}
+
+async def rebuild_rollups():
+    """Recompute every rollup from users, sessions and attendance with
+    server-side $group/$merge into a staging collection, swap it in with one
+    rename and record the build in `migrations`. Increments landing during the
+    rebuild are lost on the rename, so this runs at startup before a worker
+    serves traffic, or from the CLI with the API stopped."""
+    staging = f"rollups_rebuild_{uuid.uuid4().hex}"
+    ended = {"$ne": ["$is_active", True]}
+    pipelines = [
+        (db.users, [
+            {"$group": {
+                "_id": "global",
+                "total_users": {"$sum": 1},
+                **{field: {"$sum": {"$cond": [{"$eq": ["$role", role]}, 1, 0]}} for role, field in ROLE_COUNTERS.items()}
+            }}
+        ]),
+        (db.sessions, [{"$group": {"_id": "global", "total_sessions": {"$sum": 1}}}]),
+        (db.sessions, [
+            {"$group": {
+                "_id": {"$concat": ["faculty:", "$faculty_id"]},
+                "total_sessions": {"$sum": 1},
+                "active_sessions": {"$sum": {"$cond": [ended, 0, 1]}},
+                "total_rate": {"$sum": {"$cond": [ended, session_rate_expr(), 0]}}
+            }}
+        ]),
+        (db.sessions, [
+            {"$match": {"is_active": {"$ne": True}}},
+            {"$group": {"_id": {"$concat": ["department:", "$department"]}, "ended_sessions": {"$sum": 1}}}
+        ]),
+        (db.sessions, [
+            {"$group": {
+                "_id": {"$concat": ["course:", "$course_code"]},
+                "sessions": {"$sum": 1},
+                "ended_sessions": {"$sum": {"$cond": [ended, 1, 0]}},
+                "total_rate": {"$sum": {"$cond": [ended, session_rate_expr(), 0]}}
+            }}
+        ]),
+        # Attendance fans out to one (key, field) pair per rollup it feeds
+        (db.attendance, [
+            {"$lookup": {"from": "sessions", "localField": "session_id", "foreignField": "id", "as": "session"}},
+            {"$unwind": "$session"},
+            {"$group": {
+                "_id": {
+                    "student_id": "$student_id",
+                    "faculty_id": "$session.faculty_id",
+                    "course_code": "$course_code",
+                    "day": {"$dateToString": {"date": "$marked_at", "format": "%Y-%m-%d"}}
+                },
+                "count": {"$sum": 1}
+            }},
+            {"$project": {"count": 1, "targets": [
+                {"key": "global", "field": "total_attendance_records"},
+                {"key": {"$concat": ["student:", "$_id.student_id"]}, "field": "attended"},
+                {"key": {"$concat": ["course:", "$_id.course_code"]}, "field": "attendance"},
+                {"key": {"$concat": ["day:all:", "$_id.day"]}, "field": "count"},
+                {"key": {"$concat": ["day:student:", "$_id.student_id", ":", "$_id.day"]}, "field": "count"},
+                {"key": {"$concat": ["day:faculty:", "$_id.faculty_id", ":", "$_id.day"]}, "field": "count"}
+            ]}},
+            {"$unwind": "$targets"},
+            {"$group": {"_id": {"key": "$targets.key", "field": "$targets.field"}, "value": {"$sum": "$count"}}},
+            {"$group": {"_id": "$_id.key", "fields": {"$push": {"k": "$_id.field", "v": "$value"}}}},
+            {"$replaceWith": {"$mergeObjects": [{"_id": "$_id"}, {"$arrayToObject": "$fields"}]}}
+        ]),
+    ]
+    try:
+        for collection, pipeline in pipelines:
+            await collection.aggregate(pipeline + [rollup_merge(staging)], allowDiskUse=True).to_list(None)
+        await db[staging].update_one({"_id": "global"}, {"$inc": {"total_users": 0}}, upsert=True)
+        documents = await db[staging].count_documents({})
+        # Concurrent rebuilds each stage separately; the last rename wins and
+        # both results are complete
+        await db[staging].rename("rollups", dropTarget=True)
+    except Exception:
+        await db[staging].drop()
+        raise
+    await db.migrations.update_one(
+        {"_id": ROLLUPS_BUILT}, {"$set": {"built_at": datetime.now(timezone.utc), "documents": documents}}, upsert=True
+    )
+    logger.info(f"Rebuilt {documents} rollup documents")
+
+# The marker is written only after a rebuild's rename, so a build that died
+# part-way (or a `global` recreated by a bump meanwhile) is never mistaken for
+# a finished one
+ROLLUPS_BUILT = "rollups_built"
+ROLLUP_BUILD_LOCK = "rollups_initial_build"
+NATIVE_DATES_LOCK = "native_dates_migration"
+STARTUP_LOCK_TIMEOUT = timedelta(seconds=int(os.getenv("STARTUP_LOCK_TIMEOUT_SECONDS", "900")))
+STARTUP_LOCK_POLL_SECONDS = float(os.getenv("STARTUP_LOCK_POLL_SECONDS", "2"))
+
+async def claim_lock(lock_id: str, timeout: timedelta) -> bool:
+    """Atomically claim a lock document in `migrations`; a claim older than
+    `timeout` is treated as abandoned and can be taken over"""
+    now = datetime.now(timezone.utc)
+    try:
+        await db.migrations.insert_one({"_id": lock_id, "owner": WORKER_ID, "claimed_at": now})
+        return True
+    except DuplicateKeyError:
+        result = await db.migrations.update_one(
+            {"_id": lock_id, "claimed_at": {"$lt": now - timeout}},
+            {"$set": {"owner": WORKER_ID, "claimed_at": now}}
+        )
+        return result.modified_count == 1
+
+async def hold_lock(lock_id: str, timeout: timedelta):
+    """Keep refreshing our claim so long work isn't taken over as abandoned"""
+    while True:
+        await asyncio.sleep(timeout.total_seconds() / 3)
+        await db.migrations.update_one(
+            {"_id": lock_id, "owner": WORKER_ID}, {"$set": {"claimed_at": datetime.now(timezone.utc)}}
+        )
+
+async def run_once_before_serving(lock_id: str, done: Callable[[], Awaitable[bool]], work: Callable[[], Awaitable[Any]]):
+    """Block startup until `done()`. The worker holding the lock runs `work`;
+    the others wait, and take the lock over if its holder dies."""
+    while not await done():
+        if not await claim_lock(lock_id, STARTUP_LOCK_TIMEOUT):
+            logger.info(f"Waiting for {lock_id} running on another worker")
+            await asyncio.sleep(STARTUP_LOCK_POLL_SECONDS)
+            continue
+        heartbeat = asyncio.create_task(hold_lock(lock_id, STARTUP_LOCK_TIMEOUT))
+        try:
+            if not await done():
+                await work()
+        finally:
+            heartbeat.cancel()
+            await db.migrations.delete_one({"_id": lock_id, "owner": WORKER_ID})
+
+async def native_dates_done() -> bool:
+    checkpoints = [f"native_dates:{collection}" for collection in DATE_FIELDS]
+    return await db.migrations.count_documents({"_id": {"$in": checkpoints}, "done": True}) == len(checkpoints)
+
+async def ensure_native_dates():
+    """Finish the date migration before serving: cursors, CSV export, offline
+    sync and date filters all assume native dates"""
+    await run_once_before_serving(NATIVE_DATES_LOCK, native_dates_done, migrate_dates_to_native)
+
+async def ensure_rollups():
+    """Build rollups on first start against a database that predates them.
+    Every worker waits until the build marker exists, so no check-in races
+    the build. Day buckets need native dates, so ensure_native_dates runs first."""
+    async def built() -> bool:
+        return await db.migrations.find_one({"_id": ROLLUPS_BUILT}, {"_id": 1}) is not None
+    await run_once_before_serving(ROLLUP_BUILD_LOCK, built, rebuild_rollups)
+
+# Keyset pagination: list endpoints sort on (timestamp, id) descending and
+# hand out an opaque cursor for the last row in X-Next-Cursor
+PAGE_SIZE_MAX = 1000
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+def encode_cursor(sort_value: datetime, doc_id: str) -> str:
+    raw = json.dumps([sort_value.isoformat(), doc_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        sort_value, doc_id = json.loads(raw)
+        return datetime.fromisoformat(sort_value), str(doc_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def keyset_query(query: dict, sort_field: str, after: Optional[str]) -> dict:
+    if not after:
+        return query
+    sort_value, doc_id = decode_cursor(after)
+    return {"$and": [query, {"$or": [
+        {sort_field: {"$lt": sort_value}},
+        {sort_field: sort_value, "id": {"$lt": doc_id}}
+    ]}]}
+
+def keyset_cursor(collection, query: dict, sort_field: str, after: Optional[str], projection: dict):
+    return collection.find(keyset_query(query, sort_field, after), projection).sort([(sort_field, -1), ("id", -1)])
+
+async def fetch_page(collection, query: dict, sort_field: str, limit: int, after: Optional[str], response: Response, projection: dict) -> List[dict]:
+    """One page of results; sets the next-page cursor header when more remain"""
+    docs = await keyset_cursor(collection, query, sort_field, after, projection).to_list(limit + 1)
+    if len(docs) > limit:
+        docs = docs[:limit]
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(docs[-1][sort_field], docs[-1]["id"])
+    return docs
+
+def stream_ndjson(cursor) -> StreamingResponse:
+    """Stream a Motor cursor as newline-delimited JSON, one batch in memory at a time"""
+    async def lines():
+        async for doc in cursor:
+            yield dumps(doc) + b"\n"
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+# Attendance export: rows are joined with their session and streamed in
+# chunks so a campus-wide term export runs in constant memory
+EXPORT_COLUMNS = [
+    "session_id", "course_code", "course_name", "department", "faculty_id", "faculty_name",
+    "student_id", "student_name", "marked_at", "verification_method", "confidence_score"
+]
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", "5000"))
+
+def export_pipeline(match: dict) -> List[dict]:
+    return [
+        {"$match": match},
+        {"$lookup": {"from": "sessions", "localField": "session_id", "foreignField": "id", "as": "session"}},
+        {"$unwind": "$session"},
+        {"$project": {
+            "_id": 0,
+            "session_id": 1, "course_code": 1, "student_id": 1, "student_name": 1,
+            "marked_at": 1, "verification_method": 1, "confidence_score": 1,
+            "course_name": "$session.course_name",
+            "department": "$session.department",
+            "faculty_id": "$session.faculty_id",
+            "faculty_name": "$session.faculty_name"
+        }}
+    ]
+
+async def export_chunks(cursor):
+    chunk = []
+    async for row in cursor:
+        chunk.append(row)
+        if len(chunk) >= EXPORT_CHUNK_ROWS:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def rows_to_csv(rows: List[dict], header: bool) -> str:
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_COLUMNS, extrasaction="ignore")
+    if header:
+        writer.writeheader()
+    for row in rows:
+        writer.writerow({**row, "marked_at": row["marked_at"].isoformat() if row.get("marked_at") else ""})
+    return buffer.getvalue()
+
+async def stream_csv(cursor):
+    yield rows_to_csv([], header=True)
+    async for chunk in export_chunks(cursor):
+        yield rows_to_csv(chunk, header=False)
+
+class ParquetSink(io.RawIOBase):
+    """Write-only file object that hands written bytes back to the generator"""
+    def __init__(self):
+        self.chunks: List[bytes] = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+async def stream_parquet(cursor):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    
+    schema = pa.schema([
+        (column, pa.timestamp("ms", tz="UTC") if column == "marked_at" else pa.float64() if column == "confidence_score" else pa.string())
+        for column in EXPORT_COLUMNS
+    ])
+    sink = ParquetSink()
+    writer = pq.ParquetWriter(sink, schema)
+    
+    def write_row_group(rows: List[dict]):
+        writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+    
+    try:
+        async for chunk in export_chunks(cursor):
+            # Encoding a row group is CPU work; keep it off the event loop
+            await asyncio.to_thread(write_row_group, chunk)
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
 
 # Root route
 @api_router.get("/")
@@ -243,20 +1876,29 @@ async def root():
 @api_router.post("/auth/register", response_model=Token)
 async def register(user_data: UserCreate):
     # Check if user exists
-    existing_user = await db.users.find_one({"email": user_data.email})
+    existing_user = await db.users.find_one({"email": user_data.email}, {"_id": 0, "email": 1})  # covered by email_unique
     if existing_user:
         raise HTTPException(status_code=400, detail="Email already registered")
     
     # Create user
-    hashed_password = get_password_hash(user_data.password)
+    hashed_password = await run_password_job(get_password_hash, user_data.password)
     user_dict = user_data.model_dump(exclude={"password"})
     user = User(**user_dict)
     
     doc = user.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
     doc['hashed_password'] = hashed_password
     
-    await db.users.insert_one(doc)
+    try:
+        await db.users.insert_one(doc)
+    except DuplicateKeyError:
+        # Lost a race with a concurrent registration (email_unique)
+        raise HTTPException(status_code=400, detail="Email already registered")
+    
+    user_counts = {"total_users": 1}
+    if user.role in ROLE_COUNTERS:
+        user_counts[ROLE_COUNTERS[user.role]] = 1
+    await bump_rollups({"global": user_counts})
+    await response_versions.bump("global")
     
     # Create token
     access_token = create_access_token(
@@ -268,12 +1910,18 @@ async def register(user_data: UserCreate):
 
 @api_router.post("/auth/login", response_model=Token)
 async def login(credentials: UserLogin):
-    user_doc = await db.users.find_one({"email": credentials.email}, {"_id": 0})
-    if not user_doc or not verify_password(credentials.password, user_doc.get("hashed_password", "")):
+    user_doc = await db.users.find_one({"email": credentials.email}, {**USER_PROJECTION, "hashed_password": 1})
+    if not user_doc:
         raise HTTPException(status_code=401, detail="Incorrect email or password")
     
-    if isinstance(user_doc.get('created_at'), str):
-        user_doc['created_at'] = datetime.fromisoformat(user_doc['created_at'])
+    valid, new_hash = await run_password_job(
+        pwd_context.verify_and_update, credentials.password, user_doc.get("hashed_password", "")
+    )
+    if not valid:
+        raise HTTPException(status_code=401, detail="Incorrect email or password")
+    if new_hash:
+        # Stored hash used a different cost factor
+        await db.users.update_one({"id": user_doc["id"]}, {"$set": {"hashed_password": new_hash}})
     
     user = User(**{k: v for k, v in user_doc.items() if k != 'hashed_password'})
     
@@ -302,23 +1950,29 @@ async def create_session(session_data: SessionCreate, current_user: User = Depen
     )
     
     doc = session.model_dump()
-    doc['start_time'] = doc['start_time'].isoformat()
-    if doc['end_time']:
-        doc['end_time'] = doc['end_time'].isoformat()
-    doc['created_at'] = doc['created_at'].isoformat()
     
     await db.sessions.insert_one(doc)
+    doc.pop("_id", None)
+    cache_active_session(doc)
+    await response_versions.bump(*session_scopes(doc))
+    await bump_rollups({
+        "global": {"total_sessions": 1},
+        f"faculty:{current_user.id}": {"total_sessions": 1, "active_sessions": 1},
+        f"course:{session.course_code}": {"sessions": 1}
+    })
     
-    # Broadcast new session
-    await manager.broadcast({
+    # The creating faculty follows check-ins for this session
+    manager.subscribe_user(current_user.id, session_channel(session.id))
+    
+    # Broadcast new session to students of the department
+    await manager.broadcast_to_department({
         "type": "session_created",
         "session": doc
-    })
+    }, session.department)
     
     return session
 
-@api_router.get("/sessions", response_model=List[Session])
-async def get_sessions(active_only: bool = False, current_user: User = Depends(get_current_user)):
+def sessions_query(active_only: bool, current_user: User) -> dict:
     query = {}
     if active_only:
         query["is_active"] = True
@@ -327,79 +1981,140 @@ async def get_sessions(active_only: bool = False, current_user: User = Depends(g
         query["faculty_id"] = current_user.id
     elif current_user.role == "student":
         query["department"] = current_user.department
+    return query
+
+@api_router.get("/sessions", response_model=List[Session])
+async def get_sessions(
+    request: Request,
+    response: Response,
+    active_only: bool = False,
+    limit: int = Query(PAGE_SIZE_MAX, ge=1, le=PAGE_SIZE_MAX),
+    after: Optional[str] = None,
+    current_user: User = Depends(get_current_user)
+):
+    not_modified = await response_versions.check(request, response, reader_scopes(current_user))
+    if not_modified:
+        return not_modified
     
-    sessions = await db.sessions.find(query, {"_id": 0}).sort("start_time", -1).to_list(1000)
-    
-    for session in sessions:
-        if isinstance(session.get('start_time'), str):
-            session['start_time'] = datetime.fromisoformat(session['start_time'])
-        if session.get('end_time') and isinstance(session['end_time'], str):
-            session['end_time'] = datetime.fromisoformat(session['end_time'])
-        if isinstance(session.get('created_at'), str):
-            session['created_at'] = datetime.fromisoformat(session['created_at'])
+    query = sessions_query(active_only, current_user)
+    sessions = await fetch_page(db.sessions, query, "start_time", limit, after, response, SESSION_PROJECTION)
     
-    return sessions
+    return list_response(sessions, response)
+
+@api_router.get("/sessions/stream")
+async def stream_sessions(active_only: bool = False, after: Optional[str] = None, current_user: User = Depends(get_current_user)):
+    """All matching sessions as NDJSON"""
+    return stream_ndjson(keyset_cursor(db.sessions, sessions_query(active_only, current_user), "start_time", after, SESSION_PROJECTION))
 
 @api_router.get("/sessions/{session_id}", response_model=Session)
 async def get_session(session_id: str, current_user: User = Depends(get_current_user)):
-    session = await db.sessions.find_one({"id": session_id}, {"_id": 0})
+    session = await db.sessions.find_one({"id": session_id}, SESSION_PROJECTION)
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
     
-    if isinstance(session.get('start_time'), str):
-        session['start_time'] = datetime.fromisoformat(session['start_time'])
-    if session.get('end_time') and isinstance(session['end_time'], str):
-        session['end_time'] = datetime.fromisoformat(session['end_time'])
-    if isinstance(session.get('created_at'), str):
-        session['created_at'] = datetime.fromisoformat(session['created_at'])
-    
     return Session(**session)
 
 @api_router.post("/sessions/{session_id}/end")
 async def end_session(session_id: str, current_user: User = Depends(get_current_user)):
-    session = await db.sessions.find_one({"id": session_id})
+    session = await get_session_record(session_id)
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
     
     if session["faculty_id"] != current_user.id and current_user.role != "admin":
         raise HTTPException(status_code=403, detail="Not authorized")
     
-    await db.sessions.update_one(
-        {"id": session_id},
-        {"$set": {"is_active": False, "end_time": datetime.now(timezone.utc).isoformat()}}
+    # Only the request that flips is_active folds the session into the rollups
+    result = await db.sessions.update_one(
+        {"id": session_id, "is_active": True},
+        {"$set": {"is_active": False, "end_time": datetime.now(timezone.utc)}}
     )
+    active_session_cache.invalidate(session_id)
+    await response_versions.bump(*session_scopes(session))
+    
+    if result.modified_count:
+        ended = await db.sessions.find_one({"id": session_id}, {"_id": 0, "present_count": 1, "total_students": 1})
+        rate = session_rate(ended)
+        await bump_rollups({
+            f"faculty:{session['faculty_id']}": {"active_sessions": -1, "total_rate": rate},
+            f"department:{session['department']}": {"ended_sessions": 1},
+            f"course:{session['course_code']}": {"ended_sessions": 1, "total_rate": rate}
+        })
     
     # Broadcast session ended
-    await manager.broadcast({
+    ended_message = {
         "type": "session_ended",
-        "session_id": session_id
-    })
+        "session_id": session_id,
+        "department": session["department"],
+        "faculty_id": session["faculty_id"]
+    }
+    await manager.broadcast_to_session(ended_message, session_id)
+    await manager.broadcast_to_department(ended_message, session["department"])
     
     return {"message": "Session ended successfully"}
 
-# Attendance routes
-@api_router.post("/attendance", response_model=Attendance)
-async def mark_attendance(attendance_data: AttendanceCreate, current_user: User = Depends(get_current_user)):
-    if current_user.role != "student":
-        raise HTTPException(status_code=403, detail="Only students can mark attendance")
-    
-    # Check if session exists and is active
-    session = await db.sessions.find_one({"id": attendance_data.session_id})
+# Rotating QR tokens: "<session_id>.<time step>.<signature>" where the signature
+# is an HMAC over the session id and step, so scans verify without a DB read
+QR_TOKEN_STEP_SECONDS = int(os.getenv("QR_TOKEN_STEP_SECONDS", "30"))
+QR_TOKEN_GRACE_STEPS = int(os.getenv("QR_TOKEN_GRACE_STEPS", "1"))  # previous steps still accepted
+QR_SIGNING_KEY = hmac.new(SECRET_KEY.encode(), b"qr-token", hashlib.sha256).digest()
+
+def qr_time_step(at: Optional[float] = None) -> int:
+    return int((time.time() if at is None else at) // QR_TOKEN_STEP_SECONDS)
+
+def qr_signature(session_id: str, step: int) -> str:
+    digest = hmac.new(QR_SIGNING_KEY, f"{session_id}:{step}".encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest[:16]).rstrip(b"=").decode()
+
+def issue_qr_token(session_id: str, step: int) -> str:
+    return f"{session_id}.{step}.{qr_signature(session_id, step)}"
+
+def verify_qr_token(token: str, session_id: str, at: Optional[float] = None) -> bool:
+    """True if the token was issued for session_id within the accepted time steps"""
+    try:
+        token_session_id, step, signature = token.rsplit(".", 2)
+        step = int(step)
+    except ValueError:
+        return False
+    current = qr_time_step(at)
+    if token_session_id != session_id or not current - QR_TOKEN_GRACE_STEPS <= step <= current:
+        return False
+    return hmac.compare_digest(signature, qr_signature(session_id, step))
+
+@api_router.get("/sessions/{session_id}/qr")
+async def get_session_qr(session_id: str, current_user: User = Depends(get_current_user)):
+    """Current QR payload for the projector; poll again after refresh_in seconds"""
+    session = await get_session_record(session_id)
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
+    if session["faculty_id"] != current_user.id and current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Not authorized")
     if not session["is_active"]:
         raise HTTPException(status_code=400, detail="Session is not active")
     
-    # Check if already marked
-    existing = await db.attendance.find_one({
-        "session_id": attendance_data.session_id,
-        "student_id": current_user.id
-    })
-    if existing:
-        raise HTTPException(status_code=400, detail="Attendance already marked for this session")
-    
-    # Simulate face recognition
-    face_result = await simulate_face_recognition(current_user.id)
+    now = time.time()
+    step = qr_time_step(now)
+    expires_at = (step + 1) * QR_TOKEN_STEP_SECONDS
+    return {
+        "token": issue_qr_token(session_id, step),
+        "step": step,
+        "expires_at": datetime.fromtimestamp(expires_at, timezone.utc),
+        # Scans captured at or after this are rejected, including offline ones
+        "accepted_until": datetime.fromtimestamp(expires_at + QR_TOKEN_GRACE_STEPS * QR_TOKEN_STEP_SECONDS, timezone.utc),
+        "refresh_in": round(expires_at - now, 3)
+    }
+
+# Attendance routes
+async def check_in(attendance_data: AttendanceCreate, session: dict, current_user: User) -> Attendance:
+    """Verify the student's face (or scanned QR token) and record attendance for an active session"""
+    if attendance_data.verification_method == "qr":
+        # Token already checked in mark_attendance; no face match to score
+        face_result = {"success": True, "confidence": 1.0}
+    else:
+        try:
+            face_result = await face_verifier.verify(current_user.id)
+        except Exception as e:
+            logger.error(f"Face verification error: {str(e)}")
+            raise HTTPException(status_code=503, detail="Face verification is temporarily unavailable")
     if not face_result["success"]:
         raise HTTPException(status_code=400, detail="Face verification failed")
     
@@ -414,76 +2129,488 @@ async def mark_attendance(attendance_data: AttendanceCreate, current_user: User
     )
     
     doc = attendance.model_dump()
-    doc['marked_at'] = doc['marked_at'].isoformat()
     
-    await db.attendance.insert_one(doc)
+    # The unique (session_id, student_id) index rejects repeat check-ins
+    try:
+        await db.attendance.insert_one(doc)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Attendance already marked for this session")
+    await response_versions.bump(f"user:{current_user.id}", *session_scopes(session))
     
-    # Update session counts
-    present_count = await db.attendance.count_documents({"session_id": attendance_data.session_id})
-    await db.sessions.update_one(
+    # Update session count atomically now that the insert has succeeded
+    updated_session = await db.sessions.find_one_and_update(
         {"id": attendance_data.session_id},
-        {"$set": {"present_count": present_count}}
+        {"$inc": {"present_count": 1}},
+        projection={"_id": 0, "present_count": 1},
+        return_document=ReturnDocument.AFTER
     )
+    present_count = updated_session["present_count"] if updated_session else 0
     
-    # Broadcast attendance update
-    await manager.broadcast_to_session({
-        "type": "attendance_marked",
-        "session_id": attendance_data.session_id,
-        "student_name": current_user.name,
-        "present_count": present_count
-    }, attendance_data.session_id)
+    rollup_updates = {}
+    add_attendance_rollups(rollup_updates, attendance, session["faculty_id"])
+    await bump_rollups(rollup_updates)
+    
+    # Broadcast attendance update (coalesced per session)
+    await attendance_events.add(session, [current_user.id], [current_user.name], present_count)
     
     return attendance
 
+async def run_check_in_job(job_id: str, attendance_data: AttendanceCreate, session: dict, current_user: User):
+    job = {"job_id": job_id, "session_id": attendance_data.session_id}
+    try:
+        attendance = await check_in(attendance_data, session, current_user)
+        job.update(status="verified", attendance=attendance.model_dump(mode="json"))
+        message = {"type": "attendance_verified", **job}
+    except HTTPException as e:
+        job.update(status="rejected", detail=e.detail)
+        message = {"type": "attendance_rejected", **job}
+    except Exception as e:
+        logger.error(f"Check-in job {job_id} failed: {str(e)}")
+        job.update(status="rejected", detail="Verification error")
+        message = {"type": "attendance_rejected", **job}
+    
+    verification_jobs.set(job_id, {**job, "student_id": current_user.id})
+    await manager.send_personal_message(message, current_user.id)
+
+@api_router.post(
+    "/attendance",
+    response_model=Attendance,
+    responses={202: {"description": "Verification queued; the result is pushed over WebSocket"}}
+)
+async def mark_attendance(attendance_data: AttendanceCreate, wait: bool = True, current_user: User = Depends(get_current_user)):
+    if current_user.role != "student":
+        raise HTTPException(status_code=403, detail="Only students can mark attendance")
+    
+    qr_scan = attendance_data.verification_method == "qr"
+    if qr_scan and not verify_qr_token(attendance_data.qr_token or "", attendance_data.session_id):
+        raise HTTPException(status_code=400, detail="Invalid or expired QR code")
+    
+    # Check if session exists and is active
+    session = await get_session_record(attendance_data.session_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="Session not found")
+    if not session["is_active"]:
+        raise HTTPException(status_code=400, detail="Session is not active")
+    
+    if wait or qr_scan:
+        return await check_in(attendance_data, session, current_user)
+    
+    # Accept now; attendance_verified / attendance_rejected follows on /ws
+    job_id = str(uuid.uuid4())
+    job = {"job_id": job_id, "session_id": attendance_data.session_id, "status": "pending"}
+    verification_jobs.set(job_id, {**job, "student_id": current_user.id})
+    task = asyncio.create_task(run_check_in_job(job_id, attendance_data, session, current_user))
+    check_in_tasks.add(task)
+    task.add_done_callback(check_in_tasks.discard)
+    return JSONResponse(status_code=202, content=job)
+
+BATCH_SESSION_PROJECTION = {"_id": 0, "id": 1, "faculty_id": 1, "department": 1, "course_code": 1, "is_active": 1, "start_time": 1, "end_time": 1, "total_students": 1}
+
+async def insert_attendance_batch(pending: List[tuple]) -> Dict[int, dict]:
+    """Insert (Attendance, session, extra fields) entries unordered, then update
+    present_count, rollups and broadcasts once per session for the rows that
+    landed. Returns the write errors keyed by position in `pending`."""
+    if not pending:
+        return {}
+    
+    # Unordered insert: rows the unique index rejects don't stop the rest
+    failed = {}
+    try:
+        await db.attendance.insert_many([{**attendance.model_dump(), **extra} for attendance, _, extra in pending], ordered=False)
+    except BulkWriteError as e:
+        for error in e.details.get("writeErrors", []):
+            failed[error["index"]] = error
+    
+    inserted_by_session: Dict[str, List[str]] = {}
+    student_ids_by_session: Dict[str, List[str]] = {}
+    sessions: Dict[str, dict] = {}
+    rollup_updates: Dict[str, Dict[str, float]] = {}
+    scopes: Set[str] = set()
+    for position, (attendance, session, _) in enumerate(pending):
+        if position not in failed:
+            inserted_by_session.setdefault(attendance.session_id, []).append(attendance.student_name)
+            student_ids_by_session.setdefault(attendance.session_id, []).append(attendance.student_id)
+            sessions[attendance.session_id] = session
+            add_attendance_rollups(rollup_updates, attendance, session["faculty_id"])
+            scopes.update([f"user:{attendance.student_id}", *session_scopes(session)])
+    if not inserted_by_session:
+        return failed
+    await response_versions.bump(*scopes)
+    
+    for session_id, names in inserted_by_session.items():
+        session = sessions[session_id]
+        if not session["is_active"] and session.get("total_students", 0) > 0:
+            # Already folded into the rate rollups when it ended; add the late rows
+            rate = len(names) / session["total_students"] * 100
+            for key in (f"faculty:{session['faculty_id']}", f"course:{session['course_code']}"):
+                fields = rollup_updates.setdefault(key, {})
+                fields["total_rate"] = fields.get("total_rate", 0) + rate
+    
+    await db.sessions.bulk_write(
+        [UpdateOne({"id": session_id}, {"$inc": {"present_count": len(names)}}) for session_id, names in inserted_by_session.items()],
+        ordered=False
+    )
+    await bump_rollups(rollup_updates)
+    counts = await db.sessions.find(
+        {"id": {"$in": list(inserted_by_session)}},
+        {"_id": 0, "id": 1, "present_count": 1}
+    ).to_list(None)
+    for session in counts:
+        await attendance_events.add(
+            sessions[session["id"]],
+            student_ids_by_session[session["id"]],
+            inserted_by_session[session["id"]],
+            session.get("present_count", 0)
+        )
+    return failed
+
+BULK_ATTENDANCE_MAX_ROWS = int(os.getenv("BULK_ATTENDANCE_MAX_ROWS", "10000"))
+
+async def ingest_attendance(records: List[BulkAttendanceRecord], verification_method: Literal["manual", "qr"], current_user: User) -> dict:
+    """Validate a batch of (session, student) pairs, insert them unordered and
+    update counts, rollups and broadcasts once per batch"""
+    if len(records) > BULK_ATTENDANCE_MAX_ROWS:
+        raise HTTPException(status_code=413, detail=f"At most {BULK_ATTENDANCE_MAX_ROWS} rows per batch")
+    
+    session_ids = list({record.session_id for record in records})
+    student_keys = list({record.student_id for record in records})
+    sessions = {
+        session["id"]: session
+        for session in await db.sessions.find(
+            {"id": {"$in": session_ids}},
+            BATCH_SESSION_PROJECTION
+        ).to_list(None)
+    }
+    students = {}
+    async for student in db.users.find(
+        {"role": "student", "$or": [{"id": {"$in": student_keys}}, {"student_id": {"$in": student_keys}}]},
+        {"_id": 0, "id": 1, "name": 1, "student_id": 1}
+    ):
+        students[student["id"]] = student
+        if student.get("student_id"):
+            students.setdefault(student["student_id"], student)
+    
+    results = []
+    pending = []  # (result index, Attendance, session)
+    seen = set()
+    for row, record in enumerate(records):
+        result = {"row": row, "session_id": record.session_id, "student_id": record.student_id}
+        results.append(result)
+        session = sessions.get(record.session_id)
+        student = students.get(record.student_id)
+        if not session:
+            result.update(status="error", detail="Session not found")
+        elif session["faculty_id"] != current_user.id and current_user.role != "admin":
+            result.update(status="error", detail="Not authorized")
+        elif not session["is_active"]:
+            result.update(status="error", detail="Session is not active")
+        elif not student:
+            result.update(status="error", detail="Student not found")
+        elif (record.session_id, student["id"]) in seen:
+            result.update(status="already_marked", detail="Duplicate row in batch")
+        else:
+            seen.add((record.session_id, student["id"]))
+            attendance = Attendance(
+                session_id=record.session_id,
+                student_id=student["id"],
+                student_name=student["name"],
+                course_code=session["course_code"],
+                verification_method=verification_method,
+                confidence_score=1.0
+            )
+            pending.append((row, attendance, session))
+    
+    failed = await insert_attendance_batch([(attendance, session, {}) for _, attendance, session in pending])
+    for position, (row, attendance, _) in enumerate(pending):
+        error = failed.get(position)
+        if error is None:
+            results[row].update(status="marked", student_id=attendance.student_id)
+        elif error.get("code") == 11000:
+            results[row].update(status="already_marked", detail="Attendance already marked for this session")
+        else:
+            results[row].update(status="error", detail=error.get("errmsg", "Insert failed"))
+    
+    summary = {"total": len(results), "marked": 0, "already_marked": 0, "error": 0}
+    for result in results:
+        summary[result["status"]] += 1
+    return {**summary, "results": results}
+
+@api_router.post("/attendance/bulk")
+async def bulk_mark_attendance(batch: BulkAttendanceCreate, current_user: User = Depends(get_current_user)):
+    """Mark attendance for many (session, student) pairs at once"""
+    if current_user.role not in ["faculty", "admin"]:
+        raise HTTPException(status_code=403, detail="Only faculty and admins can bulk mark attendance")
+    return await ingest_attendance(batch.records, batch.verification_method, current_user)
+
+@api_router.post("/attendance/bulk/csv")
+async def bulk_mark_attendance_csv(
+    file: UploadFile = File(...),
+    session_id: Optional[str] = None,
+    verification_method: Literal["manual", "qr"] = "manual",
+    current_user: User = Depends(get_current_user)
+):
+    """Mark attendance from a roster CSV with a student_id column and either a
+    session_id column or a session_id query parameter"""
+    if current_user.role not in ["faculty", "admin"]:
+        raise HTTPException(status_code=403, detail="Only faculty and admins can bulk mark attendance")
+    
+    try:
+        reader = csv.DictReader(io.StringIO((await file.read()).decode("utf-8-sig")))
+        records = [
+            BulkAttendanceRecord(session_id=(row.get("session_id") or session_id or "").strip(), student_id=row["student_id"].strip())
+            for row in reader
+        ]
+    except (UnicodeDecodeError, KeyError, AttributeError, csv.Error):
+        raise HTTPException(status_code=400, detail="CSV must be UTF-8 with a student_id column")
+    
+    return await ingest_attendance(records, verification_method, current_user)
+
+# Offline check-ins: a student without connectivity scans the projector's
+# rotating QR token, and the client signs (client_id, session, captured_at,
+# token) with a per-student key fetched while online. The signing key only
+# ties the item to the student; presence rests on the server-issued token,
+# whose time step must match captured_at. Syncs are accepted up to
+# OFFLINE_SYNC_GRACE after the session ends.
+OFFLINE_SYNC_MAX_CHECK_INS = int(os.getenv("OFFLINE_SYNC_MAX_CHECK_INS", "500"))
+OFFLINE_CLOCK_SKEW = timedelta(seconds=int(os.getenv("OFFLINE_CLOCK_SKEW_SECONDS", "120")))
+OFFLINE_SYNC_GRACE = timedelta(seconds=int(os.getenv("OFFLINE_SYNC_GRACE_SECONDS", "86400")))
+
+def offline_signing_key(user_id: str) -> bytes:
+    return hmac.new(SECRET_KEY.encode(), f"offline-check-in:{user_id}".encode(), hashlib.sha256).digest()
+
+def verify_offline_signature(user_id: str, check_in: OfflineCheckIn) -> bool:
+    message = f"{check_in.client_id}|{check_in.session_id}|{check_in.captured_at}|{check_in.qr_token}".encode()
+    expected = hmac.new(offline_signing_key(user_id), message, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, check_in.signature.lower())
+
+@api_router.get("/attendance/offline-key")
+async def get_offline_key(current_user: User = Depends(get_current_user)):
+    if current_user.role != "student":
+        raise HTTPException(status_code=403, detail="Only students can mark attendance")
+    return {"key": base64.b64encode(offline_signing_key(current_user.id)).decode(), "algorithm": "HMAC-SHA256"}
+
+@api_router.post("/attendance/sync")
+async def sync_offline_attendance(batch: OfflineSyncRequest, current_user: User = Depends(get_current_user)):
+    """Process a batch of signed offline check-ins in one pass"""
+    if current_user.role != "student":
+        raise HTTPException(status_code=403, detail="Only students can mark attendance")
+    if len(batch.check_ins) > OFFLINE_SYNC_MAX_CHECK_INS:
+        raise HTTPException(status_code=413, detail=f"At most {OFFLINE_SYNC_MAX_CHECK_INS} check-ins per sync")
+    
+    client_ids = [check_in.client_id for check_in in batch.check_ins]
+    synced = {
+        doc["client_id"]: doc
+        for doc in await db.attendance.find(
+            {"client_id": {"$in": client_ids}, "student_id": current_user.id},
+            {"_id": 0, "client_id": 1, "id": 1}
+        ).to_list(None)
+    }
+    sessions = {
+        session["id"]: session
+        for session in await db.sessions.find(
+            {"id": {"$in": list({check_in.session_id for check_in in batch.check_ins})}},
+            BATCH_SESSION_PROJECTION
+        ).to_list(None)
+    }
+    
+    now = datetime.now(timezone.utc)
+    results = []
+    candidates = []  # (result, check-in, session, captured_at)
+    seen = set()
+    for check_in in batch.check_ins:
+        result = {"client_id": check_in.client_id, "session_id": check_in.session_id}
+        results.append(result)
+        if check_in.client_id in synced:
+            # Retry of a check-in that already landed
+            result.update(status="marked", attendance_id=synced[check_in.client_id]["id"])
+            continue
+        if check_in.client_id in seen:
+            result.update(status="rejected", detail="Duplicate client_id in batch")
+            continue
+        seen.add(check_in.client_id)
+        
+        if not verify_offline_signature(current_user.id, check_in):
+            result.update(status="rejected", detail="Invalid signature")
+            continue
+        try:
+            # Stored in UTC so day rollups match what rebuild_rollups computes
+            captured_at = parse_timestamp(check_in.captured_at).astimezone(timezone.utc)
+        except ValueError:
+            result.update(status="rejected", detail="Invalid captured_at")
+            continue
+        if not verify_qr_token(check_in.qr_token, check_in.session_id, captured_at.timestamp()):
+            result.update(status="rejected", detail="QR code does not match the session and capture time")
+            continue
+        session = sessions.get(check_in.session_id)
+        if not session:
+            result.update(status="rejected", detail="Session not found")
+            continue
+        end_time = session.get("end_time")
+        if end_time is not None and now > end_time + OFFLINE_SYNC_GRACE:
+            result.update(status="rejected", detail="Session ended too long ago to sync")
+            continue
+        window_end = min(end_time or now, now) + OFFLINE_CLOCK_SKEW
+        if not session["start_time"] - OFFLINE_CLOCK_SKEW <= captured_at <= window_end:
+            result.update(status="rejected", detail="Captured outside the session window")
+            continue
+        candidates.append((result, check_in, session, captured_at))
+    
+    pending = []
+    pending_results = []
+    for result, check_in, session, captured_at in candidates:
+        attendance = Attendance(
+            session_id=check_in.session_id,
+            student_id=current_user.id,
+            student_name=current_user.name,
+            course_code=session["course_code"],
+            marked_at=captured_at,
+            verification_method="qr",
+            confidence_score=1.0
+        )
+        pending.append((attendance, session, {"client_id": check_in.client_id}))
+        pending_results.append(result)
+    
+    failed = await insert_attendance_batch(pending)
+    for position, ((attendance, _, _), result) in enumerate(zip(pending, pending_results)):
+        error = failed.get(position)
+        if error is None:
+            result.update(status="marked", attendance_id=attendance.id)
+        elif error.get("code") == 11000:
+            result.update(status="already_marked", detail="Attendance already marked for this session")
+        else:
+            result.update(status="rejected", detail=error.get("errmsg", "Insert failed"))
+    
+    return {"results": results}
+
+@api_router.get("/attendance/jobs/{job_id}")
+async def get_check_in_job(job_id: str, current_user: User = Depends(get_current_user)):
+    job = verification_jobs.get(job_id)
+    if not job or job["student_id"] != current_user.id:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return {k: v for k, v in job.items() if k != "student_id"}
+
+@api_router.get("/attendance/export")
+async def export_attendance(
+    format: str = Query("csv", pattern="^(csv|parquet)$"),
+    department: Optional[str] = None,
+    course_code: Optional[str] = None,
+    faculty_id: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    current_user: User = Depends(get_current_user)
+):
+    """Stream attendance joined with session details as CSV or Parquet"""
+    if current_user.role not in ["faculty", "admin"]:
+        raise HTTPException(status_code=403, detail="Not authorized")
+    if current_user.role == "faculty":
+        faculty_id = current_user.id
+    
+    match = {}
+    if course_code:
+        match["course_code"] = course_code
+    if start or end:
+        match["marked_at"] = {}
+        if start:
+            match["marked_at"]["$gte"] = start if start.tzinfo else start.replace(tzinfo=timezone.utc)
+        if end:
+            match["marked_at"]["$lt"] = end if end.tzinfo else end.replace(tzinfo=timezone.utc)
+    
+    session_match = {}
+    if department:
+        session_match["department"] = department
+    if faculty_id:
+        session_match["faculty_id"] = faculty_id
+    if session_match:
+        # Department and faculty live on the session; resolve them to session ids
+        sessions = await db.sessions.find(session_match, {"_id": 0, "id": 1}).to_list(None)
+        match["session_id"] = {"$in": [session["id"] for session in sessions]}
+    
+    cursor = db.attendance.aggregate(export_pipeline(match))
+    filename = f"attendance-{datetime.now(timezone.utc):%Y%m%d%H%M%S}.{format}"
+    headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
+    if format == "parquet":
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise HTTPException(status_code=501, detail="Parquet export requires pyarrow")
+        return StreamingResponse(stream_parquet(cursor), media_type="application/vnd.apache.parquet", headers=headers)
+    return StreamingResponse(stream_csv(cursor), media_type="text/csv", headers=headers)
+
 @api_router.get("/attendance/my-history", response_model=List[Attendance])
-async def get_my_attendance(current_user: User = Depends(get_current_user)):
+async def get_my_attendance(
+    request: Request,
+    response: Response,
+    limit: int = Query(PAGE_SIZE_MAX, ge=1, le=PAGE_SIZE_MAX),
+    after: Optional[str] = None,
+    current_user: User = Depends(get_current_user)
+):
     if current_user.role != "student":
         raise HTTPException(status_code=403, detail="Only students can view their attendance")
     
-    attendance_records = await db.attendance.find(
-        {"student_id": current_user.id},
-        {"_id": 0}
-    ).sort("marked_at", -1).to_list(1000)
+    not_modified = await response_versions.check(request, response, [f"user:{current_user.id}"])
+    if not_modified:
+        return not_modified
     
-    for record in attendance_records:
-        if isinstance(record.get('marked_at'), str):
-            record['marked_at'] = datetime.fromisoformat(record['marked_at'])
+    attendance_records = await fetch_page(db.attendance, {"student_id": current_user.id}, "marked_at", limit, after, response, ATTENDANCE_PROJECTION)
     
-    return attendance_records
+    return list_response(attendance_records, response)
 
-@api_router.get("/attendance/session/{session_id}", response_model=List[Attendance])
-async def get_session_attendance(session_id: str, current_user: User = Depends(get_current_user)):
-    session = await db.sessions.find_one({"id": session_id})
+@api_router.get("/attendance/my-history/stream")
+async def stream_my_attendance(after: Optional[str] = None, current_user: User = Depends(get_current_user)):
+    """Full attendance history as NDJSON"""
+    if current_user.role != "student":
+        raise HTTPException(status_code=403, detail="Only students can view their attendance")
+    
+    return stream_ndjson(keyset_cursor(db.attendance, {"student_id": current_user.id}, "marked_at", after, ATTENDANCE_PROJECTION))
+
+async def authorize_session_attendance(session_id: str, current_user: User):
+    session = await get_session_record(session_id)
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
     
     if current_user.role == "faculty" and session["faculty_id"] != current_user.id and current_user.role != "admin":
         raise HTTPException(status_code=403, detail="Not authorized")
+
+@api_router.get("/attendance/session/{session_id}", response_model=List[Attendance])
+async def get_session_attendance(
+    session_id: str,
+    response: Response,
+    limit: int = Query(PAGE_SIZE_MAX, ge=1, le=PAGE_SIZE_MAX),
+    after: Optional[str] = None,
+    current_user: User = Depends(get_current_user)
+):
+    await authorize_session_attendance(session_id, current_user)
     
-    attendance_records = await db.attendance.find(
-        {"session_id": session_id},
-        {"_id": 0}
-    ).sort("marked_at", -1).to_list(1000)
+    attendance_records = await fetch_page(db.attendance, {"session_id": session_id}, "marked_at", limit, after, response, ATTENDANCE_PROJECTION)
     
-    for record in attendance_records:
-        if isinstance(record.get('marked_at'), str):
-            record['marked_at'] = datetime.fromisoformat(record['marked_at'])
+    return list_response(attendance_records, response)
+
+@api_router.get("/attendance/session/{session_id}/stream")
+async def stream_session_attendance(session_id: str, after: Optional[str] = None, current_user: User = Depends(get_current_user)):
+    """Full attendance list of a session as NDJSON"""
+    await authorize_session_attendance(session_id, current_user)
     
-    return attendance_records
+    return stream_ndjson(keyset_cursor(db.attendance, {"session_id": session_id}, "marked_at", after, ATTENDANCE_PROJECTION))
 
 # Analytics routes
 @api_router.get("/analytics/overview")
-async def get_analytics_overview(current_user: User = Depends(get_current_user)):
+async def get_analytics_overview(request: Request, response: Response, current_user: User = Depends(get_current_user)):
+    scopes = reader_scopes(current_user) + ([f"user:{current_user.id}"] if current_user.role == "student" else [])
+    not_modified = await response_versions.check(request, response, scopes)
+    if not_modified:
+        return not_modified
+    
     if current_user.role == "student":
         # Student analytics
-        total_sessions = await db.sessions.count_documents({"department": current_user.department, "is_active": False})
-        attended = await db.attendance.count_documents({"student_id": current_user.id})
+        rollups = await get_rollups([f"department:{current_user.department}", f"student:{current_user.id}"], ["ended_sessions", "attended"])
+        total_sessions = rollups.get(f"department:{current_user.department}", {}).get("ended_sessions", 0)
+        attended = rollups.get(f"student:{current_user.id}", {}).get("attended", 0)
         attendance_rate = (attended / total_sessions * 100) if total_sessions > 0 else 0
         
         # Recent attendance
         recent = await db.attendance.find(
             {"student_id": current_user.id},
-            {"_id": 0}
+            ATTENDANCE_PROJECTION
         ).sort("marked_at", -1).limit(10).to_list(10)
         
         return {
@@ -495,71 +2622,98 @@ async def get_analytics_overview(current_user: User = Depends(get_current_user))
     
     elif current_user.role == "faculty":
         # Faculty analytics
-        total_sessions = await db.sessions.count_documents({"faculty_id": current_user.id})
-        active_sessions = await db.sessions.count_documents({"faculty_id": current_user.id, "is_active": True})
+        stats = (await get_rollups([f"faculty:{current_user.id}"], ["total_sessions", "active_sessions", "total_rate"])).get(f"faculty:{current_user.id}", {})
+        total_sessions = stats.get("total_sessions", 0)
+        active_sessions = stats.get("active_sessions", 0)
+        completed_sessions = total_sessions - active_sessions
         
-        # Average attendance rate
-        sessions = await db.sessions.find({"faculty_id": current_user.id, "is_active": False}).to_list(1000)
-        total_rate = 0
-        for session in sessions:
-            attendance_count = await db.attendance.count_documents({"session_id": session["id"]})
-            if session.get("total_students", 0) > 0:
-                total_rate += (attendance_count / session["total_students"] * 100)
-        
-        avg_rate = (total_rate / len(sessions)) if sessions else 0
+        avg_rate = (stats.get("total_rate", 0) / completed_sessions) if completed_sessions else 0
         
         return {
             "total_sessions": total_sessions,
             "active_sessions": active_sessions,
-            "completed_sessions": total_sessions - active_sessions,
+            "completed_sessions": completed_sessions,
             "average_attendance_rate": round(avg_rate, 2)
         }
     
     else:  # admin
         # System-wide analytics
-        total_users = await db.users.count_documents({})
-        total_students = await db.users.count_documents({"role": "student"})
-        total_faculty = await db.users.count_documents({"role": "faculty"})
-        total_sessions = await db.sessions.count_documents({})
-        total_attendance = await db.attendance.count_documents({})
+        stats = (await get_rollups(["global"], ["total_users", "total_students", "total_faculty", "total_sessions", "total_attendance_records"])).get("global", {})
         
         return {
-            "total_users": total_users,
-            "total_students": total_students,
-            "total_faculty": total_faculty,
-            "total_sessions": total_sessions,
-            "total_attendance_records": total_attendance
+            "total_users": stats.get("total_users", 0),
+            "total_students": stats.get("total_students", 0),
+            "total_faculty": stats.get("total_faculty", 0),
+            "total_sessions": stats.get("total_sessions", 0),
+            "total_attendance_records": stats.get("total_attendance_records", 0)
         }
 
+TREND_LABEL_FORMATS = {"hour": "%Y-%m-%dT%H:00", "day": "%Y-%m-%d", "week": "%Y-%m-%d"}
+
 @api_router.get("/analytics/trends")
-async def get_attendance_trends(current_user: User = Depends(get_current_user)):
+async def get_attendance_trends(
+    days: int = Query(7, ge=1, le=366),
+    granularity: str = Query("day", pattern="^(hour|day|week)$"),
+    tz: str = "UTC",
+    current_user: User = Depends(get_current_user)
+):
     """Get attendance trends over time"""
-    # Get last 7 days of data
-    seven_days_ago = datetime.now(timezone.utc) - timedelta(days=7)
+    try:
+        zone = ZoneInfo(tz)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise HTTPException(status_code=400, detail="Unknown timezone")
     
-    query = {}
+    if current_user.role == "student":
+        scope = f"student:{current_user.id}"
+    elif current_user.role == "faculty":
+        scope = f"faculty:{current_user.id}"
+    else:
+        scope = "all"
+    
+    # Both branches cover the same window: the last `days` calendar days in
+    # `tz`, today included
+    today = datetime.now(zone).date()
+    first_day = today - timedelta(days=days - 1)
+    
+    # Daily UTC buckets are already materialized in the rollups
+    if granularity == "day" and tz == "UTC":
+        day_keys = [(first_day + timedelta(days=offset)).isoformat() for offset in range(days)]
+        rollups = await get_rollups([f"day:{scope}:{day}" for day in day_keys], ["count"])
+        trends = [
+            {"date": day, "count": rollups[f"day:{scope}:{day}"]["count"]}
+            for day in day_keys if rollups.get(f"day:{scope}:{day}", {}).get("count")
+        ]
+        return {"trends": trends}
+    
+    # Otherwise filter and bucket inside MongoDB
+    since = datetime.combine(first_day, datetime.min.time(), tzinfo=zone).astimezone(timezone.utc)
+    query = {"marked_at": {"$gte": since}}
     if current_user.role == "student":
         query["student_id"] = current_user.id
     elif current_user.role == "faculty":
-        sessions = await db.sessions.find({"faculty_id": current_user.id}).to_list(1000)
-        session_ids = [s["id"] for s in sessions]
-        query["session_id"] = {"$in": session_ids}
-    
-    attendance_records = await db.attendance.find(query).to_list(10000)
-    
-    # Group by date
-    daily_counts = {}
-    for record in attendance_records:
-        marked_at = record.get('marked_at')
-        if isinstance(marked_at, str):
-            marked_at = datetime.fromisoformat(marked_at)
-        
-        if marked_at >= seven_days_ago:
-            date_key = marked_at.strftime('%Y-%m-%d')
-            daily_counts[date_key] = daily_counts.get(date_key, 0) + 1
+        sessions = await db.sessions.find({"faculty_id": current_user.id}, {"_id": 0, "id": 1}).to_list(None)
+        query["session_id"] = {"$in": [session["id"] for session in sessions]}
     
-    # Format for frontend
-    trends = [{"date": date, "count": count} for date, count in sorted(daily_counts.items())]
+    pipeline = [
+        {"$match": query},
+        {"$project": {"_id": 0, "marked_at": 1}},
+        {"$group": {
+            "_id": {"$dateTrunc": {
+                "date": "$marked_at",
+                "unit": granularity,
+                "timezone": tz,
+                "startOfWeek": "monday"
+            }},
+            "count": {"$sum": 1}
+        }},
+        {"$sort": {"_id": 1}},
+        {"$project": {
+            "_id": 0,
+            "date": {"$dateToString": {"date": "$_id", "format": TREND_LABEL_FORMATS[granularity], "timezone": tz}},
+            "count": 1
+        }}
+    ]
+    trends = await db.attendance.aggregate(pipeline).to_list(None)
     
     return {"trends": trends}
 
@@ -569,23 +2723,62 @@ async def get_analytics_ai_insights(current_user: User = Depends(get_current_use
     if current_user.role not in ["faculty", "admin"]:
         raise HTTPException(status_code=403, detail="Not authorized")
     
-    # Gather data for AI analysis
-    sessions = await db.sessions.find({}).limit(50).to_list(50)
-    attendance_data = []
-    
-    for session in sessions:
-        attendance_count = await db.attendance.count_documents({"session_id": session["id"]})
-        total_students = session.get("total_students", 50)  # Default estimate
-        attendance_rate = (attendance_count / total_students * 100) if total_students > 0 else 0
-        attendance_data.append({
-            "session_id": session["id"],
-            "course_code": session["course_code"],
-            "attendance_count": attendance_count,
-            "attendance_rate": attendance_rate
-        })
-    
-    insights = await get_ai_insights(attendance_data)
-    return insights
+    # Served from the cache; the LLM is only called by background refreshes
+    return await ai_insights.get(AI_INSIGHTS_SCOPE)
+
+@api_router.post("/admin/reconcile-counts")
+async def reconcile_counts(current_user: User = Depends(get_current_user)):
+    if current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Not authorized")
+    repaired = await reconcile_present_counts()
+    return {"repaired_sessions": repaired}
+
+@api_router.get("/admin/indexes")
+async def get_index_report(current_user: User = Depends(get_current_user)):
+    if current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Not authorized")
+    return await check_indexes()
+
+@api_router.get("/admin/query-audit")
+async def get_query_audit(current_user: User = Depends(get_current_user)):
+    if current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Not authorized")
+    return query_audit.report()
+
+@api_router.get("/metrics/cache")
+async def get_cache_metrics(current_user: User = Depends(get_current_user)):
+    if current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Not authorized")
+    return {
+        "users": user_cache.metrics(),
+        "tokens": token_cache.metrics(),
+        "active_sessions": active_session_cache.metrics(),
+        "ai_insights": ai_insights.metrics(),
+        "conditional_get": response_versions.metrics()
+    }
+
+@api_router.get("/metrics/pools")
+async def get_pool_metrics(current_user: User = Depends(get_current_user)):
+    if current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Not authorized")
+    return {
+        "mongo": mongo_pool_metrics.metrics(),
+        "http": {
+            "max_connections": HTTP_MAX_CONNECTIONS,
+            "max_keepalive_connections": HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            "keepalive_expiry": HTTP_KEEPALIVE_EXPIRY
+        }
+    }
+
+@api_router.get("/metrics/websocket")
+async def get_websocket_metrics(current_user: User = Depends(get_current_user)):
+    if current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Not authorized")
+    return {
+        **manager.metrics(),
+        "attendance_events": attendance_events.metrics(),
+        "face_verification": face_verifier.metrics()
+    }
 
 # WebSocket endpoint
 @app.websocket("/ws/{user_id}")
@@ -594,9 +2787,28 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
     try:
         while True:
             data = await websocket.receive_text()
-            # Handle incoming messages if needed
-            await websocket.send_json({"type": "pong", "message": "Connection alive"})
+            try:
+                message = json.loads(data)
+            except ValueError:
+                message = None
+            
+            # Room membership: {"type": "subscribe", "channel": "session:<id>"}
+            if isinstance(message, dict) and message.get("type") in ("subscribe", "unsubscribe"):
+                channel = message.get("channel")
+                if not isinstance(channel, str) or not channel.startswith(CHANNEL_PREFIXES):
+                    await manager.send(websocket, {"type": "error", "message": "Unknown channel"})
+                    continue
+                if message["type"] == "subscribe":
+                    manager.subscribe(websocket, channel)
+                else:
+                    manager.unsubscribe(websocket, channel)
+                await manager.send(websocket, {"type": f"{message['type']}d", "channel": channel})
+                continue
+            
+            await manager.send(websocket, {"type": "pong", "message": "Connection alive"})
     except WebSocketDisconnect:
+        pass
+    finally:
         manager.disconnect(websocket, user_id)
 
 # Include router
@@ -608,6 +2820,7 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER],
 )
 
 logging.basicConfig(
@@ -616,6 +2829,56 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+# Lifecycle: called from the app lifespan
+async def startup():
+    global http_client
+    http_client = create_http_client()
+    await ensure_indexes()
+    await ensure_native_dates()
+    await ensure_rollups()
+    await face_verifier.start()
+    await manager.start()
+    if PRESENT_COUNT_RECONCILE_SECONDS > 0:
+        background_tasks.append(asyncio.create_task(reconcile_present_counts_periodically()))
+    background_tasks.append(asyncio.create_task(ai_insights.refresh_periodically()))
+
+async def shutdown():
+    for task in background_tasks:
+        task.cancel()
+    background_tasks.clear()
+    ai_insights.stop()
+    await face_verifier.stop()
+    await attendance_events.flush_all()
+    await manager.stop()
+    await http_client.aclose()
+    client.close()
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+    
+    parser = argparse.ArgumentParser(description="CampusTrack API maintenance")
+    parser.add_argument("--check-indexes", action="store_true", help="report missing/unused indexes and collection scans on hot queries")
+    parser.add_argument("--rebuild-rollups", action="store_true", help="recompute dashboard rollups from scratch (stop the API first)")
+    parser.add_argument("--migrate-dates", action="store_true", help="convert string timestamps to native dates (resumable)")
+    parser.add_argument("--dedupe-attendance", action="store_true", help="remove duplicate attendance rows that block the unique indexes")
+    parser.add_argument("--batch-size", type=int, default=1000, help="documents per migration batch")
+    args = parser.parse_args()
+    
+    if args.dedupe_attendance:
+        print(json.dumps(asyncio.run(dedupe_attendance())))
+        sys.exit(0)
+    
+    if args.migrate_dates:
+        print(f"Converted {asyncio.run(migrate_dates_to_native(args.batch_size))} documents")
+        sys.exit(0)
+    
+    if args.rebuild_rollups:
+        asyncio.run(rebuild_rollups())
+        sys.exit(0)
+    
+    if args.check_indexes:
+        report = asyncio.run(check_indexes())
+        print(json.dumps(report, indent=2))
+        sys.exit(1 if report["missing"] or report["collection_scans"] or report["uncovered"] else 0)
+    parser.print_help()
@@ -0,0 +1,111 @@
+import requests
+import sys
+import os
+import json
+import statistics
+import time
+from datetime import datetime, timezone
+
+class CampusTrackBenchmark:
+    def __init__(self, base_url="http://localhost:8001", repeats=20):
+        self.base_url = base_url
+        self.api_url = f"{base_url}/api"
+        self.repeats = repeats
+        self.session = requests.Session()
+
+    def request(self, method, endpoint, data=None, token=None):
+        headers = {'Content-Type': 'application/json'}
+        if token:
+            headers['Authorization'] = f'Bearer {token}'
+        response = self.session.request(method, f"{self.api_url}/{endpoint}", json=data, headers=headers, timeout=60)
+        response.raise_for_status()
+        return response.json()
+
+    def register(self, role):
+        data = self.request('POST', 'auth/register', {
+            "email": f"bench_{role}_{time.time_ns()}@test.edu",
+            "password": "BenchPass123!",
+            "name": f"Bench {role.title()}",
+            "role": role,
+            "department": "Benchmarking"
+        })
+        return data['access_token']
+
+    def time_endpoint(self, endpoint, token):
+        """Median latency in milliseconds over self.repeats calls"""
+        samples = []
+        for _ in range(self.repeats):
+            start = time.perf_counter()
+            self.request('GET', endpoint, token=token)
+            samples.append((time.perf_counter() - start) * 1000)
+        return statistics.median(samples)
+
+    def bench_faculty_overview(self, session_counts=(10, 100, 500)):
+        """/analytics/overview for a faculty should stay flat as ended sessions grow"""
+        print("Faculty /analytics/overview latency by number of ended sessions")
+        faculty_token = self.register('faculty')
+        created = 0
+        for target in session_counts:
+            while created < target:
+                session = self.request('POST', 'sessions', {
+                    "course_name": "Benchmark Course",
+                    "course_code": f"BENCH{created}",
+                    "department": "Benchmarking"
+                }, token=faculty_token)
+                self.request('POST', f"sessions/{session['id']}/end", token=faculty_token)
+                created += 1
+            median = self.time_endpoint('analytics/overview', faculty_token)
+            print(f"  {target:>6} sessions: {median:8.2f} ms")
+
+    def run_all(self):
+        self.bench_faculty_overview()
+        return 0
+
+def bench_serialization(item_counts=(100, 1000), repeats=20):
+    """Per-item cost of encoding a list response: the response_model path
+    (validate, dump to JSON-safe Python, json.dumps) against the FAST_JSON path.
+    Runs in-process; no server or database needed."""
+    os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+    os.environ.setdefault("DB_NAME", "benchmark")
+    os.environ["FAST_JSON"] = "true"
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+    from typing import List
+    from pydantic import TypeAdapter
+    import server
+    if not server.FAST_JSON:
+        print("orjson is not installed; FAST_JSON is unavailable")
+        return 1
+    
+    adapter = TypeAdapter(List[server.Attendance])
+    
+    def response_model_path(docs):
+        content = adapter.dump_python(adapter.validate_python(docs), mode="json")
+        return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode()
+    
+    print("Attendance list encoding cost per item")
+    for count in item_counts:
+        docs = [
+            server.Attendance(
+                session_id=f"session-{i % 10}",
+                student_id=f"student-{i}",
+                student_name=f"Student {i}",
+                course_code="BENCH101",
+                marked_at=datetime.now(timezone.utc)
+            ).model_dump()
+            for i in range(count)
+        ]
+        for label, encode in (("response_model", response_model_path), ("fast_json", server.dumps)):
+            samples = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                encode(docs)
+                samples.append(time.perf_counter() - start)
+            per_item = statistics.median(samples) / count * 1_000_000
+            print(f"  {count:>6} items  {label:<15} {per_item:8.2f} us/item")
+    return 0
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "serialization":
+        sys.exit(bench_serialization())
+    base_url = sys.argv[1] if len(sys.argv) > 1 else "http://localhost:8001"
+    sys.exit(CampusTrackBenchmark(base_url).run_all())
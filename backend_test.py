@@ -1,10 +1,16 @@
 import requests
 import sys
 import json
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import time
+import uuid
+import hmac
+import hashlib
+import base64
+import re
 
 class CampusTrackAPITester:
+
     def __init__(self, base_url="https://smart-attendance-54.preview.emergentagent.com"):
         self.base_url = base_url
         self.api_url = f"{base_url}/api"
@@ -62,6 +68,20 @@ class CampusTrackAPITester:
         except Exception as e:
             return False, 0, {"error": str(e)}
 
+    def create_student(self, label):
+        """Register an extra student; returns (user, token) or (None, None)"""
+        user_data = {
+            "role": "student",
+            "email": f"{label}_{time.time_ns()}@test.edu",
+            "password": "TestPass123!",
+            "name": f"Test {label.title()}",
+            "department": "Computer Science"
+        }
+        success, status, response = self.make_request('POST', 'auth/register', user_data, expected_status=200)
+        if success and 'access_token' in response:
+            return response['user'], response['access_token']
+        return None, None
+
     def test_root_endpoint(self):
         """Test root API endpoint"""
         success, status, data = self.make_request('GET', '')
@@ -218,6 +238,220 @@ class CampusTrackAPITester:
         else:
             self.log_test("Get Session Attendance", False, f"Status: {status}, Response: {response}")
 
+    def test_conditional_get(self):
+        """Test that a replayed ETag gets a 304 until a check-in changes the session list"""
+        if 'test_session' not in self.sessions:
+            self.log_test("Conditional GET", False, "No session available")
+            return
+
+        student, token = self.create_student('etag')
+        if not student:
+            self.log_test("Conditional GET", False, "Could not register etag student")
+            return
+        url = f"{self.api_url}/sessions?active_only=true"
+        headers = {'Authorization': f'Bearer {token}'}
+        try:
+            # ETags also roll over with a time bucket; retry once if the replay straddled one
+            for _ in range(2):
+                etag = requests.get(url, headers=headers, timeout=30).headers.get('ETag')
+                replay = requests.get(url, headers={**headers, 'If-None-Match': etag or ''}, timeout=30)
+                if replay.status_code == 304:
+                    break
+            self.make_request('POST', 'attendance', {"session_id": self.sessions['test_session']['id']}, token=token)
+            changed = requests.get(url, headers={**headers, 'If-None-Match': etag or ''}, timeout=30)
+        except Exception as e:
+            self.log_test("Conditional GET", False, str(e))
+            return
+
+        if etag and replay.status_code == 304 and changed.status_code == 200:
+            self.log_test("Conditional GET", True)
+        else:
+            self.log_test("Conditional GET", False, f"ETag: {etag}, replay: {replay.status_code}, after check-in: {changed.status_code}")
+
+    def test_qr_attendance(self):
+        """Test QR check-ins with a valid, a wrong-session and an expired token"""
+        if 'faculty' not in self.tokens or 'test_session' not in self.sessions:
+            self.log_test("QR Attendance", False, "No faculty token or session available")
+            return
+
+        session_id = self.sessions['test_session']['id']
+        session_data = {
+            "course_name": "QR Token Check",
+            "course_code": "CS302",
+            "department": "Computer Science"
+        }
+        _, _, other_session = self.make_request('POST', 'sessions', session_data, token=self.tokens['faculty'])
+        _, _, qr = self.make_request('GET', f'sessions/{session_id}/qr', token=self.tokens['faculty'])
+        _, _, other_qr = self.make_request('GET', f"sessions/{other_session.get('id')}/qr", token=self.tokens['faculty'])
+        students = [self.create_student(label) for label in ['qr_valid', 'qr_wrong_session', 'qr_expired']]
+        if 'token' not in qr or 'token' not in other_qr or not all(token for _, token in students):
+            self.log_test("QR Attendance", False, f"QR: {qr}, other QR: {other_qr}")
+            return
+        (_, valid_token), (_, wrong_token), (_, expired_token) = students
+
+        def scan(qr_token, student_token, expected_status):
+            attendance_data = {"session_id": session_id, "verification_method": "qr", "qr_token": qr_token}
+            return self.make_request('POST', 'attendance', attendance_data, token=student_token, expected_status=expected_status)
+
+        valid_ok, _, valid = scan(qr['token'], valid_token, 200)
+        self.log_test("QR Attendance (Valid Token)", valid_ok and valid.get('verification_method') == 'qr', f"Response: {valid}")
+
+        wrong_ok, _, wrong = scan(other_qr['token'], wrong_token, 400)
+        self.log_test("QR Attendance (Wrong Session)", wrong_ok, f"Response: {wrong}")
+
+        # Expiry is checked against the capture time, so an offline check-in
+        # captured once the grace window has passed must be rejected without
+        # waiting for it in real time
+        _, _, key_response = self.make_request('GET', 'attendance/offline-key', token=expired_token)
+        if 'key' not in key_response:
+            self.log_test("QR Attendance (Expired Token)", False, f"Key: {key_response}")
+        else:
+            key = base64.b64decode(key_response['key'])
+            accepted_until = datetime.fromisoformat(qr['accepted_until'].replace('Z', '+00:00'))
+
+            def check_in(captured_at):
+                item = {
+                    "client_id": str(uuid.uuid4()),
+                    "session_id": session_id,
+                    "captured_at": captured_at.isoformat(),
+                    "qr_token": qr['token']
+                }
+                message = f"{item['client_id']}|{item['session_id']}|{item['captured_at']}|{item['qr_token']}".encode()
+                item["signature"] = hmac.new(key, message, hashlib.sha256).hexdigest()
+                return item
+
+            check_ins = [check_in(accepted_until), check_in(accepted_until - timedelta(seconds=1))]
+            _, _, synced = self.make_request('POST', 'attendance/sync', {"check_ins": check_ins}, token=expired_token)
+            results = synced.get('results') or [{}, {}]
+            expired_ok = (results[0].get('status') == 'rejected'
+                          and results[0].get('detail') == 'QR code does not match the session and capture time'
+                          and results[1].get('status') == 'marked')
+            self.log_test("QR Attendance (Expired Token)", expired_ok, f"Response: {synced}")
+
+        self.make_request('POST', f"sessions/{other_session['id']}/end", token=self.tokens['faculty'])
+
+    def test_bulk_attendance(self):
+        """Test per-row statuses for a duplicate, an in-batch repeat and an unknown student"""
+        if 'faculty' not in self.tokens or 'test_session' not in self.sessions:
+            self.log_test("Bulk Attendance", False, "No faculty token or session available")
+            return
+
+        session_id = self.sessions['test_session']['id']
+        marked, _ = self.create_student('bulk_marked')
+        fresh, _ = self.create_student('bulk_fresh')
+        if not marked or not fresh:
+            self.log_test("Bulk Attendance", False, "Could not register bulk students")
+            return
+        self.make_request('POST', 'attendance/bulk', {"records": [{"session_id": session_id, "student_id": marked['id']}]}, token=self.tokens['faculty'])
+
+        records = [
+            {"session_id": session_id, "student_id": marked['id']},  # already marked
+            {"session_id": session_id, "student_id": fresh['id']},
+            {"session_id": session_id, "student_id": fresh['id']},  # repeat within the batch
+            {"session_id": session_id, "student_id": "no-such-student"}
+        ]
+        success, status, response = self.make_request('POST', 'attendance/bulk', {"records": records}, token=self.tokens['faculty'])
+
+        statuses = [row.get('status') for row in response.get('results', [])]
+        if success and statuses == ['already_marked', 'marked', 'already_marked', 'error'] and response.get('marked') == 1:
+            self.log_test("Bulk Attendance", True)
+        else:
+            self.log_test("Bulk Attendance", False, f"Status: {status}, Response: {response}")
+
+    def test_offline_sync(self):
+        """Test that a retried offline check-in keeps its attendance_id and a bad signature is rejected"""
+        if 'faculty' not in self.tokens or 'test_session' not in self.sessions:
+            self.log_test("Offline Sync", False, "No faculty token or session available")
+            return
+
+        session_id = self.sessions['test_session']['id']
+        student, token = self.create_student('offline')
+        if not student:
+            self.log_test("Offline Sync", False, "Could not register offline student")
+            return
+        _, _, key_response = self.make_request('GET', 'attendance/offline-key', token=token)
+        _, _, qr_response = self.make_request('GET', f'sessions/{session_id}/qr', token=self.tokens['faculty'])
+        if 'key' not in key_response or 'token' not in qr_response:
+            self.log_test("Offline Sync", False, f"Key: {key_response}, QR: {qr_response}")
+            return
+
+        key = base64.b64decode(key_response['key'])
+        def check_in(client_id, signature=None):
+            item = {
+                "client_id": client_id,
+                "session_id": session_id,
+                "captured_at": datetime.now(timezone.utc).isoformat(),
+                "qr_token": qr_response['token']
+            }
+            message = f"{item['client_id']}|{item['session_id']}|{item['captured_at']}|{item['qr_token']}".encode()
+            item["signature"] = signature or hmac.new(key, message, hashlib.sha256).hexdigest()
+            return item
+
+        item = check_in(str(uuid.uuid4()))
+        _, _, first = self.make_request('POST', 'attendance/sync', {"check_ins": [item]}, token=token)
+        _, _, retry = self.make_request('POST', 'attendance/sync', {"check_ins": [item]}, token=token)
+        _, _, forged = self.make_request('POST', 'attendance/sync', {"check_ins": [check_in(str(uuid.uuid4()), "0" * 64)]}, token=token)
+
+        first_result = (first.get('results') or [{}])[0]
+        retry_result = (retry.get('results') or [{}])[0]
+        forged_result = (forged.get('results') or [{}])[0]
+        if (first_result.get('status') == 'marked' and first_result.get('attendance_id')
+                and retry_result.get('attendance_id') == first_result['attendance_id']
+                and forged_result.get('status') == 'rejected' and forged_result.get('detail') == 'Invalid signature'):
+            self.log_test("Offline Sync", True)
+        else:
+            self.log_test("Offline Sync", False, f"First: {first}, retry: {retry}, forged: {forged}")
+
+    def test_attendance_pagination(self):
+        """Test that a limit=1 page hands out X-Next-Cursor and the next page does not overlap"""
+        if 'faculty' not in self.tokens or 'test_session' not in self.sessions:
+            self.log_test("Attendance Pagination", False, "No faculty token or session available")
+            return
+
+        session_id = self.sessions['test_session']['id']
+        # Make sure the session holds at least two rows
+        records = []
+        for label in ['page_one', 'page_two']:
+            user, _ = self.create_student(label)
+            if user:
+                records.append({"session_id": session_id, "student_id": user['id']})
+        self.make_request('POST', 'attendance/bulk', {"records": records}, token=self.tokens['faculty'])
+
+        url = f"{self.api_url}/attendance/session/{session_id}"
+        headers = {'Authorization': f"Bearer {self.tokens['faculty']}"}
+        try:
+            first = requests.get(url, params={"limit": 1}, headers=headers, timeout=30)
+            cursor = first.headers.get('X-Next-Cursor')
+            if first.status_code != 200 or not cursor:
+                self.log_test("Attendance Pagination", False, f"Status: {first.status_code}, no X-Next-Cursor on a partial page")
+                return
+            second = requests.get(url, params={"limit": 1, "after": cursor}, headers=headers, timeout=30)
+            full = requests.get(url, headers=headers, timeout=30)
+        except Exception as e:
+            self.log_test("Attendance Pagination", False, str(e))
+            return
+
+        first_ids = [row['id'] for row in first.json()]
+        second_ids = [row['id'] for row in second.json()] if second.status_code == 200 else []
+        full_ids = [row['id'] for row in full.json()] if full.status_code == 200 else []
+        if len(first_ids) == 1 and len(second_ids) == 1 and not set(first_ids) & set(second_ids) and full_ids[:2] == first_ids + second_ids:
+            self.log_test("Attendance Pagination", True)
+        else:
+            self.log_test("Attendance Pagination", False, f"First: {first_ids}, second: {second_ids}, full: {full_ids}")
+
+    def test_attendance_export(self):
+        """Test CSV attendance export for faculty"""
+        if 'faculty' not in self.tokens:
+            self.log_test("Attendance Export (CSV)", False, "No faculty token available")
+            return
+
+        success, status, response = self.make_request('GET', 'attendance/export?format=csv', token=self.tokens['faculty'])
+
+        if success and response.get('raw_response', '').startswith('session_id,course_code'):
+            self.log_test("Attendance Export (CSV)", True)
+        else:
+            self.log_test("Attendance Export (CSV)", False, f"Status: {status}, Response: {response}")
+
     def test_analytics_overview(self):
         """Test analytics overview for all roles"""
         for role in ['student', 'faculty', 'admin']:
@@ -240,6 +474,31 @@ class CampusTrackAPITester:
                 else:
                     self.log_test(f"Analytics Trends ({role.title()})", False, f"Status: {status}, Response: {response}")
 
+    def test_analytics_trends_params(self):
+        """Test trend granularity, timezone validation, days bounds and that both bucketing paths agree"""
+        if 'student' not in self.tokens or 'admin' not in self.tokens:
+            self.log_test("Analytics Trends Params", False, "No student or admin token available")
+            return
+
+        success, status, response = self.make_request('GET', 'analytics/trends?granularity=hour', token=self.tokens['student'])
+        hours = response.get('trends', []) if success else []
+        hourly_ok = (bool(hours) and all(re.fullmatch(r'\d{4}-\d{2}-\d{2}T\d{2}:00', bucket['date']) for bucket in hours)
+                     and sum(bucket['count'] for bucket in hours) >= 1)
+        self.log_test("Analytics Trends (Hourly)", hourly_ok, f"Status: {status}, Response: {response}")
+
+        success, status, response = self.make_request('GET', 'analytics/trends?tz=Mars/Base', token=self.tokens['admin'], expected_status=400)
+        self.log_test("Analytics Trends (Invalid Timezone)", success, f"Status: {status}, Response: {response}")
+
+        bounds = [(0, 422), (367, 422), (1, 200), (366, 200)]
+        results = [self.make_request('GET', f'analytics/trends?days={days}', token=self.tokens['admin'], expected_status=expected)[:2] for days, expected in bounds]
+        self.log_test("Analytics Trends (Days Bounds)", all(ok for ok, _ in results), f"Statuses: {[status for _, status in results]}")
+
+        # tz=UTC reads the daily rollups, Etc/UTC buckets in MongoDB; the windows must match
+        _, _, rollup_trends = self.make_request('GET', 'analytics/trends?days=2', token=self.tokens['admin'])
+        _, _, pipeline_trends = self.make_request('GET', 'analytics/trends?days=2&tz=Etc/UTC', token=self.tokens['admin'])
+        self.log_test("Analytics Trends (Rollups Match Pipeline)", rollup_trends.get('trends') == pipeline_trends.get('trends'),
+                      f"Rollups: {rollup_trends}, pipeline: {pipeline_trends}")
+
     def test_ai_insights(self):
         """Test AI insights for faculty and admin"""
         for role in ['faculty', 'admin']:
@@ -266,6 +525,58 @@ class CampusTrackAPITester:
         else:
             self.log_test("End Session", False, f"Status: {status}, Response: {response}")
 
+    def test_reconcile_counts(self):
+        """Test present_count reconciliation by admin"""
+        if 'admin' not in self.tokens:
+            self.log_test("Reconcile Present Counts", False, "No admin token available")
+            return
+
+        success, status, response = self.make_request('POST', 'admin/reconcile-counts', token=self.tokens['admin'])
+        if not success or not isinstance(response.get('repaired_sessions'), int):
+            self.log_test("Reconcile Present Counts", False, f"Status: {status}, Response: {response}")
+            return
+
+        # Every check-in path above moved present_count; it must equal the rows actually stored
+        if 'faculty' not in self.tokens or 'test_session' not in self.sessions:
+            self.log_test("Reconcile Present Counts", False, "No faculty token or session available")
+            return
+        session_id = self.sessions['test_session']['id']
+        _, _, session = self.make_request('GET', f'sessions/{session_id}', token=self.tokens['faculty'])
+        _, _, rows = self.make_request('GET', f'attendance/session/{session_id}', token=self.tokens['faculty'])
+
+        if isinstance(rows, list) and rows and session.get('present_count') == len(rows):
+            self.log_test("Reconcile Present Counts", True)
+        else:
+            self.log_test("Reconcile Present Counts", False, f"present_count: {session.get('present_count')}, rows: {rows if not isinstance(rows, list) else len(rows)}")
+
+    def test_index_report(self):
+        """Test that registered indexes exist and no hot query plans a collection scan"""
+        if 'admin' not in self.tokens:
+            self.log_test("Index Report", False, "No admin token available")
+            return
+
+        success, status, response = self.make_request('GET', 'admin/indexes', token=self.tokens['admin'])
+
+        if success and not response.get('missing') and not response.get('collection_scans'):
+            self.log_test("Index Report", True)
+        else:
+            self.log_test("Index Report", False, f"Status: {status}, Response: {response}")
+
+    def test_query_audit(self):
+        """Test that no endpoint exercised so far read whole documents"""
+        if 'admin' not in self.tokens:
+            self.log_test("Query Audit", False, "No admin token available")
+            return
+
+        success, status, response = self.make_request('GET', 'admin/query-audit', token=self.tokens['admin'])
+
+        if success and not response.get('enabled'):
+            self.log_test("Query Audit", False, "Audit disabled; start the server with QUERY_AUDIT=true")
+        elif success and not response.get('unprojected'):
+            self.log_test("Query Audit", True)
+        else:
+            self.log_test("Query Audit", False, f"Status: {status}, Response: {response}")
+
     def test_unauthorized_access(self):
         """Test unauthorized access scenarios"""
         # Test without token (backend returns 403 for missing token)
@@ -304,14 +615,24 @@ class CampusTrackAPITester:
         self.test_mark_attendance()
         self.test_get_attendance_history()
         self.test_get_session_attendance()
+        self.test_conditional_get()
+        self.test_qr_attendance()
+        self.test_bulk_attendance()
+        self.test_offline_sync()
+        self.test_attendance_pagination()
+        self.test_attendance_export()
         
         # Analytics tests
         self.test_analytics_overview()
         self.test_analytics_trends()
+        self.test_analytics_trends_params()
         self.test_ai_insights()
         
         # Session cleanup
         self.test_end_session()
+        self.test_reconcile_counts()
+        self.test_index_report()
+        self.test_query_audit()
         
         # Security tests
         self.test_unauthorized_access()
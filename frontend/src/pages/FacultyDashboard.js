@@ -9,7 +9,7 @@ import { Badge } from '@/components/ui/badge';
 import { Avatar, AvatarFallback } from '@/components/ui/avatar';
 import { Dialog, DialogContent, DialogDescription, DialogHeader, DialogTitle, DialogTrigger } from '@/components/ui/dialog';
 import { toast } from 'sonner';
-import { LogOut, Plus, Users, PlayCircle, StopCircle, TrendingUp, BarChart3 } from 'lucide-react';
+import { LogOut, Plus, Users, PlayCircle, StopCircle, TrendingUp, BarChart3, QrCode } from 'lucide-react';
 
 const FacultyDashboard = ({ user, onLogout }) => {
   const [sessions, setSessions] = useState([]);
@@ -23,6 +23,8 @@ const FacultyDashboard = ({ user, onLogout }) => {
     course_code: '',
     department: user.department || ''
   });
+  const [projectorSession, setProjectorSession] = useState(null);
+  const [projectorCode, setProjectorCode] = useState(null);
   const wsRef = useRef(null);
 
   useEffect(() => {
@@ -35,14 +37,46 @@ const FacultyDashboard = ({ user, onLogout }) => {
     };
   }, []);
 
+  // Projector view: the check-in code rotates, so fetch the next one when the
+  // current one stops being current
+  useEffect(() => {
+    if (!projectorSession) {
+      setProjectorCode(null);
+      return undefined;
+    }
+    let timer = null;
+    let cancelled = false;
+    const fetchCode = async () => {
+      try {
+        const response = await axios.get(`${API}/sessions/${projectorSession.id}/qr`);
+        if (cancelled) return;
+        setProjectorCode(response.data);
+        timer = setTimeout(fetchCode, Math.max(response.data.refresh_in, 1) * 1000);
+      } catch (error) {
+        if (cancelled) return;
+        toast.error(error.response?.data?.detail || 'Failed to fetch check-in code');
+        setProjectorSession(null);
+      }
+    };
+    fetchCode();
+    return () => {
+      cancelled = true;
+      clearTimeout(timer);
+    };
+  }, [projectorSession]);
+
   const connectWebSocket = () => {
     const ws = new WebSocket(`${WS_URL}/ws/${user.id}`);
-    ws.onopen = () => console.log('WebSocket connected');
+    ws.onopen = () => {
+      console.log('WebSocket connected');
+      axios.get(`${API}/sessions?active_only=true`).then((response) => subscribeToSessions(response.data));
+    };
     ws.onmessage = (event) => {
       const data = JSON.parse(event.data);
       if (data.type === 'attendance_marked') {
         fetchSessions();
-        toast.success(`${data.student_name} marked attendance`);
+        const names = data.student_names || [data.student_name];
+        toast.success(names.length > 1 ? `${names.length} students marked attendance` : `${names[0]} marked attendance`);
       }
     };
     ws.onerror = (error) => console.error('WebSocket error:', error);
@@ -60,9 +94,18 @@ const FacultyDashboard = ({ user, onLogout }) => {
     }
   };
 
+  const subscribeToSessions = (sessionList) => {
+    const ws = wsRef.current;
+    if (!ws || ws.readyState !== WebSocket.OPEN) return;
+    sessionList
+      .filter((session) => session.is_active)
+      .forEach((session) => ws.send(JSON.stringify({ type: 'subscribe', channel: `session:${session.id}` })));
+  };
+
   const fetchSessions = async () => {
     const response = await axios.get(`${API}/sessions`);
     setSessions(response.data);
+    subscribeToSessions(response.data);
   };
 
   const fetchAnalytics = async () => {
@@ -335,15 +378,25 @@ const FacultyDashboard = ({ user, onLogout }) => {
                       </div>
                     </div>
                     {session.is_active && (
-                      <Button
-                        variant="outline"
-                        className="border-red-300 text-red-600 hover:bg-red-50"
-                        onClick={() => endSession(session.id)}
-                        data-testid={`end-session-btn-${session.id}`}
-                      >
-                        <StopCircle className="w-4 h-4 mr-2" />
-                        End Session
-                      </Button>
+                      <div className="flex gap-3">
+                        <Button
+                          variant="outline"
+                          onClick={() => setProjectorSession(session)}
+                          data-testid={`show-code-btn-${session.id}`}
+                        >
+                          <QrCode className="w-4 h-4 mr-2" />
+                          Show Code
+                        </Button>
+                        <Button
+                          variant="outline"
+                          className="border-red-300 text-red-600 hover:bg-red-50"
+                          onClick={() => endSession(session.id)}
+                          data-testid={`end-session-btn-${session.id}`}
+                        >
+                          <StopCircle className="w-4 h-4 mr-2" />
+                          End Session
+                        </Button>
+                      </div>
                     )}
                   </div>
                 ))}
@@ -351,6 +404,32 @@ const FacultyDashboard = ({ user, onLogout }) => {
             )}
           </CardContent>
         </Card>
+
+        {/* Projector check-in code */}
+        <Dialog open={!!projectorSession} onOpenChange={(open) => !open && setProjectorSession(null)}>
+          <DialogContent className="max-w-2xl" data-testid="projector-code-dialog">
+            <DialogHeader>
+              <DialogTitle style={{ fontFamily: 'Space Grotesk' }}>
+                {projectorSession?.course_name} check-in code
+              </DialogTitle>
+              <DialogDescription>
+                Students without a connection enter this code to check in. It changes every few seconds.
+              </DialogDescription>
+            </DialogHeader>
+            {projectorCode ? (
+              <div className="text-center py-6">
+                <p className="font-mono text-xl break-all select-all bg-gray-50 rounded-xl p-6" data-testid="projector-code">
+                  {projectorCode.token}
+                </p>
+                <p className="text-sm text-gray-500 mt-3">
+                  Next code at {new Date(projectorCode.expires_at).toLocaleTimeString('en-US')}
+                </p>
+              </div>
+            ) : (
+              <p className="text-gray-500 text-center py-8">Loading code...</p>
+            )}
+          </DialogContent>
+        </Dialog>
       </main>
     </div>
   );
@@ -9,6 +9,19 @@ import { Avatar, AvatarFallback } from '@/components/ui/avatar';
 import { toast } from 'sonner';
 import { LogOut, Camera, CheckCircle, Clock, Calendar, TrendingUp } from 'lucide-react';
 
+const OFFLINE_KEY_STORAGE = 'campustrack_offline_key';
+const OFFLINE_QUEUE_STORAGE = 'campustrack_offline_queue';
+
+const loadOfflineQueue = () => JSON.parse(localStorage.getItem(OFFLINE_QUEUE_STORAGE) || '[]');
+const saveOfflineQueue = (queue) => localStorage.setItem(OFFLINE_QUEUE_STORAGE, JSON.stringify(queue));
+
+const signCheckIn = async (keyBase64, message) => {
+  const keyBytes = Uint8Array.from(atob(keyBase64), c => c.charCodeAt(0));
+  const key = await crypto.subtle.importKey('raw', keyBytes, { name: 'HMAC', hash: 'SHA-256' }, false, ['sign']);
+  const signature = await crypto.subtle.sign('HMAC', key, new TextEncoder().encode(message));
+  return Array.from(new Uint8Array(signature)).map(b => b.toString(16).padStart(2, '0')).join('');
+};
+
 const StudentDashboard = ({ user, onLogout }) => {
   const [sessions, setSessions] = useState([]);
   const [attendanceHistory, setAttendanceHistory] = useState([]);
@@ -20,7 +33,11 @@ const StudentDashboard = ({ user, onLogout }) => {
   useEffect(() => {
     fetchData();
     connectWebSocket();
+    fetchOfflineKey();
+    syncOfflineCheckIns();
+    window.addEventListener('online', syncOfflineCheckIns);
     return () => {
+      window.removeEventListener('online', syncOfflineCheckIns);
       if (wsRef.current) {
         wsRef.current.close();
       }
@@ -29,7 +46,12 @@ const StudentDashboard = ({ user, onLogout }) => {
 
   const connectWebSocket = () => {
     const ws = new WebSocket(`${WS_URL}/ws/${user.id}`);
-    ws.onopen = () => console.log('WebSocket connected');
+    ws.onopen = () => {
+      console.log('WebSocket connected');
+      if (user.department) {
+        ws.send(JSON.stringify({ type: 'subscribe', channel: `department:${user.department}` }));
+      }
+    };
     ws.onmessage = (event) => {
       const data = JSON.parse(event.data);
       if (data.type === 'session_created') {
@@ -67,6 +89,57 @@ const StudentDashboard = ({ user, onLogout }) => {
     setAnalytics(response.data);
   };
 
+  const fetchOfflineKey = async () => {
+    try {
+      const response = await axios.get(`${API}/attendance/offline-key`);
+      localStorage.setItem(OFFLINE_KEY_STORAGE, response.data.key);
+    } catch (error) {
+      console.error('Failed to fetch offline key:', error);
+    }
+  };
+
+  const queueOfflineCheckIn = async (sessionId) => {
+    const key = localStorage.getItem(OFFLINE_KEY_STORAGE);
+    if (!key) {
+      return false;
+    }
+    // Offline check-ins need the code currently shown on the projector
+    const capturedAt = new Date().toISOString();
+    const qrToken = window.prompt('You are offline. Enter the check-in code shown on the projector:');
+    if (!qrToken) {
+      return false;
+    }
+    const clientId = crypto.randomUUID();
+    const signature = await signCheckIn(key, `${clientId}|${sessionId}|${capturedAt}|${qrToken.trim()}`);
+    saveOfflineQueue([...loadOfflineQueue(), {
+      client_id: clientId,
+      session_id: sessionId,
+      captured_at: capturedAt,
+      qr_token: qrToken.trim(),
+      signature
+    }]);
+    return true;
+  };
+
+  const syncOfflineCheckIns = async () => {
+    const queue = loadOfflineQueue();
+    if (queue.length === 0 || !navigator.onLine) {
+      return;
+    }
+    try {
+      const response = await axios.post(`${API}/attendance/sync`, { check_ins: queue });
+      const done = new Set(response.data.results.map(result => result.client_id));
+      saveOfflineQueue(loadOfflineQueue().filter(checkIn => !done.has(checkIn.client_id)));
+      const marked = response.data.results.filter(result => result.status === 'marked').length;
+      if (marked > 0) {
+        toast.success(`Synced ${marked} offline check-in${marked > 1 ? 's' : ''}`);
+        await fetchData();
+      }
+    } catch (error) {
+      console.error('Offline sync failed:', error);
+    }
+  };
+
   const markAttendance = async (sessionId) => {
     setMarkingAttendance(true);
     try {
@@ -82,6 +155,10 @@ const StudentDashboard = ({ user, onLogout }) => {
       toast.success(`Attendance marked! Confidence: ${(response.data.confidence_score * 100).toFixed(0)}%`);
       await fetchData();
     } catch (error) {
+      if (!error.response && await queueOfflineCheckIn(sessionId)) {
+        toast.info('You are offline. Check-in saved and will sync when you reconnect.');
+        return;
+      }
       toast.error(error.response?.data?.detail || 'Failed to mark attendance');
     } finally {
       setMarkingAttendance(false);
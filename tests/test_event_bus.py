@@ -0,0 +1,76 @@
+import asyncio
+import json
+import os
+import sys
+import uuid
+from pathlib import Path
+
+# server reads these at import; the client it builds connects lazily
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "campustrack_test")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.sent = []
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, payload):
+        self.sent.append(json.loads(payload))
+
+    async def close(self, code=None):
+        pass
+
+
+async def wait_for_messages(websocket, count, timeout=1.0):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while len(websocket.sent) < count and loop.time() < deadline:
+        await asyncio.sleep(0.01)
+
+
+def test_session_ended_reaches_other_manager():
+    """Two managers sharing one in-memory bus behave like two workers behind a broker"""
+    async def run():
+        bus = server.InMemoryEventBus()
+        publisher = server.ConnectionManager(bus)
+        receiver = server.ConnectionManager(bus)
+        receiver.add_listener(server.track_session_events)
+        await publisher.start()
+        await receiver.start()
+
+        session_id = str(uuid.uuid4())
+        server.cache_active_session({
+            "id": session_id,
+            "is_active": True,
+            "course_code": "CS101",
+            "faculty_id": "faculty",
+            "department": "Computer Science"
+        })
+        assert server.active_session_cache.get(session_id) is not None
+
+        subscribed, other = FakeWebSocket(), FakeWebSocket()
+        await receiver.connect(subscribed, "student")
+        await receiver.connect(other, "other_student")
+        receiver.subscribe(subscribed, server.session_channel(session_id))
+
+        message = {"type": "session_ended", "session_id": session_id}
+        await publisher.broadcast_to_session(message, session_id)
+        await wait_for_messages(subscribed, 1)
+
+        try:
+            assert subscribed.sent == [message]
+            assert other.sent == []
+            assert server.active_session_cache.get(session_id) is None
+        finally:
+            receiver.disconnect(subscribed, "student")
+            receiver.disconnect(other, "other_student")
+            await publisher.stop()
+            await receiver.stop()
+
+    asyncio.run(run())